@@ -1,10 +1,202 @@
 import pylab as py
+import numpy as np
+import os
+import hashlib
+import tempfile
+import mmap
+import struct
+import json
+import zlib
+import copy
 from scipy.interpolate import interp1d
 import scipy.signal as signal
-import sys
-from uncertainties import unumpy
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+try:
+    #only needed for validating the analytic uncertainty propagation
+    from uncertainties import unumpy
+except ImportError:
+    unumpy=None
+
+def loadTextTrace(fname,params):
+    #loads one measurement file, params describes the fileformat (see THzTdData.PARAMS)
+    #try to load the file with name fname
+    #it should be possible to write this shorter
+    try:
+        #if no Y_col is specified            
+        if params.has_key('Y_col'):
+            #import it right away
+            if params['dec_sep']=='.':
+                data=py.loadtxt(fname,
+                            usecols=(params['time_col'],
+                                     params['X_col'],
+                                     params['Y_col']),
+                            skiprows=params['skiprows'])
+                            
+            elif params['dec_sep']==',':
+                #if the decimal separator is , do a replacement
+                data=_loadCommaSeparated(fname,
+                            (params['time_col'],
+                             params['X_col'],
+                             params['Y_col']),
+                            params['skiprows'])
+        else:
+            #import it right away
+            if params['dec_sep']=='.':
+                data=py.loadtxt(fname,
+                            usecols=(params['time_col'],
+                                     params['X_col']),
+                            skiprows=params['skiprows'])
+                            
+            elif params['dec_sep']==',':
+                #if the decimal separator is , do a replacement
+                data=_loadCommaSeparated(fname,
+                            (params['time_col'],
+                             params['X_col']),
+                            params['skiprows'])
+            dummy_Y=py.zeros((data.shape[0],1))
+            data=py.column_stack((data,dummy_Y))
+    except IOError:
+        raise IOError("File " + fname + " could not be loaded")
+
+    #scale the timaaxis
+    data[:,0]*=params['time_factor']
+    
+    #if the measurement was taken in negative time direction, flip the data
+    if data[1,0]-data[0,0]<0:
+        data=py.flipud(data)
+ 
+    return data
+
+def _loadCommaSeparated(fname,usecols,skiprows=0):
+    #loads the columns usecols of a whitespace separated file with , as decimal separator,
+    #the separator is replaced in the whole buffer and all values are parsed at once
+    fobj=open(fname,'rb')
+    try:
+        text=fobj.read()
+    finally:
+        fobj.close()
+    if skiprows>0:
+        text=text.split(b'\n',skiprows)[-1]
+    text=text.replace(b',',b'.')
+    
+    lines=[line for line in text.splitlines() if line.strip()]
+    data=None
+    if len(lines)>0:
+        ncols=len(lines[0].split())
+        try:
+            values=py.fromstring(text,sep=' ')
+        except ValueError:
+            values=py.array([])
+        if ncols>max(usecols) and len(values)==ncols*len(lines):
+            data=values.reshape(len(lines),ncols)[:,list(usecols)]
+    
+    if data is None:
+        #comments, ragged lines or the like, let loadtxt do the work
+        str2float=lambda val: float(val.replace(',','.'))
+        data=py.loadtxt(fname,
+                    converters=dict([(col,str2float) for col in usecols]),
+                    usecols=usecols,
+                    skiprows=skiprows)
+    return data
+
+def _nextFastLen(n):
+    #the smallest number 2**a*3**b*5**c>=n, fft lengths like this are fast
+    n=max(int(n),1)
+    best=1<<(n-1).bit_length()
+    p5=1
+    while p5<best:
+        p35=p5
+        while p35<best:
+            #the smallest power of two, that brings p35 to n
+            p2=1<<((n+p35-1)//p35-1).bit_length()
+            best=min(best,p35*p2)
+            p35*=3
+        p5*=5
+    return best
+
+def _chirpz(x,f0,df,M,dt,sign=-1):
+    #sum(x*exp(sign*2j*pi*f*n*dt)) over n for the M frequencies f=f0+k*df (chirp-z transform,
+    #Bluestein), costs a few ffts of length >=len(x)+M-1 instead of len(x)*M operations
+    N=len(x)
+    L=_nextFastLen(N+M-1)
+    #f*n=f0*n+df*(n**2+k**2-(k-n)**2)/2
+    alpha=sign*2*py.pi*dt*df
+    n=py.arange(N)
+    k=py.arange(M)
+    y=x*py.exp(sign*2j*py.pi*dt*f0*n+0.5j*alpha*n**2)
+    h=py.zeros(L,dtype=complex)
+    h[:M]=py.exp(-0.5j*alpha*k**2)
+    h[L-N+1:]=py.exp(-0.5j*alpha*py.arange(-N+1,0)**2)
+    conv=py.ifft(py.fft(y,L)*py.fft(h))[:M]
+    return conv*py.exp(0.5j*alpha*k**2)
+
+def _calculateDFT(data,freqs,times,dt):
+    #sum(data*exp(2j*pi*f*t)) over the time axis times for every f in freqs
+    #if the time axis is equidistant and freqs lie on the fft grid, this is a single fft,
+    #for other equidistant freqs a chirp-z transform,
+    #otherwise the sums are evaluated directly, blockwise to limit the memory
+    N=len(times)
+    freqs=py.asarray(freqs)
+    kf=freqs*N*dt
+    k=py.rint(kf)
+    uniform=py.allclose(times-times[0],py.arange(N)*dt,rtol=0,atol=1e-6*dt)
+    if uniform and py.allclose(kf,k,rtol=0,atol=1e-6):
+        #sum(data*exp(2j*pi*k*n/N))=N*ifft(data)[k]
+        spec=N*py.ifft(data)
+        return spec[k.astype(int)%N]*py.exp(2j*py.pi*freqs*times[0])
+    
+    M=len(freqs)
+    if uniform and M>2:
+        df=(freqs[-1]-freqs[0])/(M-1)
+        if df!=0 and py.allclose(freqs,freqs[0]+py.arange(M)*df,rtol=0,atol=1e-6*abs(df)):
+            return _chirpz(data,freqs[0],df,M,dt,1)*py.exp(2j*py.pi*freqs*times[0])
+    
+    dft=py.zeros(len(freqs),dtype=complex)
+    block=max(1,int(2**22/N))
+    for i in range(0,len(freqs),block):
+        dft[i:i+block]=py.dot(py.exp(2j*py.pi*py.outer(freqs[i:i+block],times)),data)
+    return dft
+
+def _importWorker(args):
+    #imports one file inside a worker of THzTdData._importfiles
+    tdData,fname,params,cache=args
+    try:
+        if cache is None:
+            return tdData.importfile(fname,params)
+        importer=tdData.__class__.__name__
+        data=cache.load(fname,params,importer)
+        if data is None:
+            data=tdData.importfile(fname,params)
+            cache.store(fname,params,data,importer)
+        return data
+    except IOError:
+        raise
+    except Exception as e:
+        raise IOError("File " + fname + " could not be loaded: " + str(e))
 
 class THzTdData():
+    #backend for the uncertainty propagation of the lock-in rotation:
+    #'analytic' (closed form) or 'unumpy' (slow, for validation only)
+    UNC_BACKEND='analytic'
+    #how the peaks of the single measurements are aligned in _removeTimeShift:
+    #'upsample' (cubic upsampling around the maximum), 'parabolic' (parabola through the
+    #maximum and its neighbours) or 'xcorr' (fft cross-correlation against the mean trace)
+    ALIGN_MODE='upsample'
+    #an ImportCache, that is used by all instances if no cache is passed
+    IMPORT_CACHE=None
+    #if set, files are imported and averaged in chunks using at most about MEMBUDGET bytes,
+    #the raw data is then kept in a memory-mapped temporary file (see _streamRawData)
+    MEMBUDGET=None
+    #working memory of the preprocessing per raw value, used to size the chunks
+    STREAM_OVERHEAD=10
+    #the default fileformat of the measurement files, passed to importfile
+    PARAMS={'time_factor':1,
+            'time_col':0,
+            'X_col':1,
+            'Y_col':2,
+            'dec_sep':'.',
+            'skiprows':0}
 
     def __init__(self,*kw,**kwargs):
         '''
@@ -12,22 +204,31 @@ class THzTdData():
         Instances can be initialized by
         1) create TDData Object from measurement files, without passing 'existing'
         2) create TDData Object from existing TDData Object by passing 'existing'
+        when loading files, workers=n imports them with n threads (or processes, if
+        pooltype='process' is passed), cache=ImportCache(...) reuses the already parsed files,
+        membudget=bytes averages them in chunks without keeping all of them in memory,
+        the raw data is spooled to a temporary file in spooldir
         '''
         #_thzdata_raw is an array of measurments,dim=3, for each measurement
         # an array t,X,Y is stored
         self._thzdata_raw=[]
+        #the running statistics of the average, see addMeasurement
+        self._runningStats=None
+        #memoized quantities derived from the data, _version counts the changes of the data
+        self.derivedCache=DerivedCache()
+        self._version=0
+        if 'alignmode' in kwargs:
+            self.ALIGN_MODE=kwargs['alignmode']
+        #the shifts of the single measurements applied by _removeTimeShift and their std
+        self.timeShifts=py.zeros(1)
+        self.timeJitter=0
         #two different constructors: 
         if not 'existing' in kwargs:
             #create instance by loading from the filenames provided as first argument
             filenames=kw[0]
             if len(kw)<2:
-                #if no parameter set is set, use the following dictionary
-                params={'time_factor':1,
-                        'time_col':0,
-                        'X_col':1,
-                        'Y_col':2,
-                        'dec_sep':'.',
-                        'skiprows':0}
+                #if no parameter set is set, use the default fileformat
+                params=self.PARAMS
             else:
                 #else use the passed dictionary with the fileformat
                 params=kw[1]
@@ -37,12 +238,24 @@ class THzTdData():
             #number of measurements
             self.numberOfDataSets=len(self.filename)
             
-            #import files
-            for fname in self.filename:
-                self._thzdata_raw.append(self.importfile(fname,params))
-            
-            #calculate TDData array along with uncertainties and so on
-            self.resetTDData()
+            workers=kwargs.get('workers',1)
+            pooltype=kwargs.get('pooltype','thread')
+            cache=kwargs.get('cache',self.IMPORT_CACHE)
+            membudget=kwargs.get('membudget',self.MEMBUDGET)
+            if membudget is not None:
+                #import and average the files chunk by chunk
+                self._streamRawData(params,workers,pooltype,cache,membudget,
+                                    kwargs.get('spooldir',None))
+            else:
+                #import files
+                self._thzdata_raw=self._importrange(0,self.numberOfDataSets,params,
+                                                    workers,pooltype,cache)
+                
+                #calculate TDData array along with uncertainties and so on
+                self.resetTDData()
+            #trim the cache once per import, not after every stored file
+            if cache is not None:
+                cache.evict()
         else:
             #the second constructor (with keyword), provides at least a 
             #TDData array
@@ -60,13 +273,20 @@ class THzTdData():
             if len(kw)>2:
                 self._thzdata_raw=kw[2]
     
+    def copy(self):
+        #a new THzTdData with the same data, the arrays are shared (they are never changed in
+        #place, every change rebinds them), the derived values are copied along
+        new=copy.copy(self)
+        new.derivedCache=self.derivedCache.copy()
+        return new
+
     def calcTDData(self,tdDatas):
         #tdDatas is a a 3d array of measurements, along with their uncertainties
         #meantdData is the weighted sum of the different measurements
         #meantdData,sumofweights=py.average(tdDatas[:,:,1:3],axis=0,weights=1.0/tdDatas[:,:,3:]**2,returned=True)
         meantdData=py.average(tdDatas[:,:,1:3],axis=0)
         #use error propagation formula
-        noise=py.sqrt(py.mean(self.getAllPrecNoise()[0]**2))
+        noise=self._precNoiseLevel()
         if tdDatas.shape[0]==1:
             rep = py.zeros((len(tdDatas[0,:,0]),2))
         else:
@@ -76,6 +296,10 @@ class THzTdData():
         #time axis are all equal
         return py.column_stack((tdDatas[0][:,0],meantdData,unc))       
     
+    def calculateDFT(self,data,freqs):
+        #evaluates sum(data*exp(2j*pi*f*t)) over the time axis for every f in freqs
+        return _calculateDFT(data,freqs,self.getTimes(),self.dt)
+    
     def calcunc(self,tdDatas):
         #not used anymore, older version, should we remove it???
          #tdDatas is a np array of tdData measurements
@@ -108,20 +332,12 @@ class THzTdData():
     
     def getAllPrecNoise(self,timePreceedingSignal=-1):
         #returns the concatenated Preceeding Noise
-        precNoise=py.array([])
-        for tdData in self._thzdata_raw:
-            tN=self.getPreceedingNoise(tdData,timePreceedingSignal)
-            if precNoise.shape[0]==0:
-                precNoise=tN
-            else:
-                precNoise=py.vstack((precNoise,tN))
-        return precNoise
-    
+        return self.derivedCache.get(('precNoise',timePreceedingSignal),
+                                     self._calculateAllPrecNoise,timePreceedingSignal)
+
     def getDR(self):
         #returns the dynamic range
-        Emax=abs(self.getEX())
-        noise=py.sqrt(py.mean(self.getAllPrecNoise()[0]**2))
-        return Emax/noise
+        return self.derivedCache.get('DR',self._calculateDR)
     
     def getelnNoise(self,tdData):
         #returns the uncertainty due to electronic noise
@@ -169,7 +385,11 @@ class THzTdData():
 
     def getPeakPosition(self):
         #gives the time, at which the signal is maximal
-        return self.tdData[py.argmax(self.getEX()),0]
+        return self.derivedCache.get('peak',self._calculatePeakPosition)
+
+    def getVersion(self):
+        #a counter, that changes whenever the data changes
+        return self._version
     
     def getPreceedingNoise(self,tdData,timePreceedingSignal=-1):
         #retruns the preceeding noise in X and Y channel of tdData
@@ -219,6 +439,14 @@ class THzTdData():
         #returns the time colon in ps
         return self.getTimes()*1e12
 
+    def getTimeJitter(self):
+        #returns the std of the peak positions of the single measurements
+        return self.timeJitter
+
+    def getTimeShifts(self):
+        #returns the time shifts that were applied to the single measurements for aligning them
+        return self.timeShifts
+
     def getTimeWindowLength(self):
         #returns thetime from the signal peak to the end of the measurement
         peak=self.getPeakPosition()
@@ -233,90 +461,184 @@ class THzTdData():
         return self.tdData[:,4]
     
     def getWindowedData(self,windowlength_time=1e-12):
-        #returns the blackmanwindowed tdData
+        #returns the blackmanwindowed tdData, tdData itself stays unchanged
         N=int(windowlength_time/self.dt)
         w=py.blackman(N*2)
         w=py.hstack((w[0:N],py.ones((self.getLength()-N*2),),w[N:]))
-        windowedData=self.tdData
-        #this could be written more elegantly?!
-        windowedData[:,1]*=w
-        windowedData[:,2]*=w
-        windowedData[:,3]*=w
-        windowedData[:,4]*=w
+        windowedData=self.tdData.copy()
+        windowedData[:,1:5]*=w[:,py.newaxis]
         return windowedData
     
 
     def importfile(self,fname,params):
         # if even more sophisticated things are needed, just inherit THzTdData class
         #and override the importfile method
-        #try to load the file with name fname
-        #it should be possible to write this shorter
-        try:
-            #if no Y_col is specified            
-            if params.has_key('Y_col'):
-                #import it right away
-                if params['dec_sep']=='.':
-                    data=py.loadtxt(fname,
-                                usecols=(params['time_col'],
-                                         params['X_col'],
-                                         params['Y_col']),
-                                skiprows=params['skiprows'])
-                                
-                elif params['dec_sep']==',':
-                    #if the decimal separator is , do a replacement
-                    str2float=lambda val: float(val.replace(',','.'))
-                    data=py.loadtxt(fname,
-                                converters={params['time_col']:str2float,
-                                            params['X_col']:str2float,
-                                            params['Y_col']:str2float},
-                                usecols=(params['time_col'],
-                                         params['X_col'],
-                                         params['Y_col']),
-                                skiprows=params['skiprows'])                
-            else:
-                #import it right away
-                if params['dec_sep']=='.':
-                    data=py.loadtxt(fname,
-                                usecols=(params['time_col'],
-                                         params['X_col']),
-                                skiprows=params['skiprows'])
-                                
-                elif params['dec_sep']==',':
-                    #if the decimal separator is , do a replacement
-                    str2float=lambda val: float(val.replace(',','.'))
-                    data=py.loadtxt(fname,
-                                converters={params['time_col']:str2float,
-                                            params['X_col']:str2float},
-                                usecols=(params['time_col'],
-                                         params['X_col']),
-                                skiprows=params['skiprows'])
-                dummy_Y=py.zeros((data.shape[0],1))
-                data=py.column_stack((data,dummy_Y))
-        except IOError:
-            print "File " + fname + " could not be loaded"
-            sys.exit()
-
-        #scale the timaaxis
-        data[:,0]*=params['time_factor']
-        
-        #if the measurement was taken in negative time direction, flip the data
-        if data[1,0]-data[0,0]<0:
-            data=py.flipud(data)
-     
-        return data
-    
+        return loadTextTrace(fname,params)
+
     def resetTDData(self):
         #recalculate the mean tdData
+        #the rawdata is replaced by the rotated rawdata, the list may be shared with copies
+        self._dataChanged()
+        self._thzdata_raw=list(self._thzdata_raw)
         #do some data preprocessing of the rawdata
         processedData=self._processRawData(self._thzdata_raw)
         #calculate the mean
         meanData=self.calcTDData(processedData)
         #set the tdData to the calculated meanData
         self.setTDData(meanData)
+        self._initRunningStats(processedData)
+
+    def addMeasurement(self,tdData,filename='None'):
+        #adds one more raw measurement (array t,X,Y) to the average,
+        #the running mean and variance are updated (Welford) with the new trace only, unless it
+        #shortens the common time axis or ALIGN_MODE is 'xcorr', then everything is recalculated
+        tdData=py.array(tdData,dtype=float)
+        self._thzdata_raw=list(self._thzdata_raw)+[tdData]
+        self.filename=list(self.filename)+[filename]
+        self.numberOfDataSets+=1
+        self._dataChanged()
+        
+        stats=self._runningStats
+        if stats is None or self.ALIGN_MODE=='xcorr':
+            self.resetTDData()
+            return
+        
+        t=self._rotateToXChannel(tdData)
+        #as in _preprocessRawData, the rawdata keeps the rotated X and Y channel
+        self._thzdata_raw[-1]=t[:,:tdData.shape[1]]
+        t=self._removeLinearDrift(t)
+        peak=self._peakPositions([t])[0]
+        #the common time axis relative to the mean peak position has to stay the same
+        start,end,length=stats['axis']
+        if t[0,0]-peak>start or t[-1,0]-peak<end or len(t[:,0])<length:
+            self.resetTDData()
+            return
+        
+        #the statistics may be shared with copies, build new ones
+        stats=dict(stats)
+        stats['peaks']=stats['peaks']+[peak]
+        mp=self._setPeakPositions(stats['peaks'])
+        x=self._alignTrace(t,peak,mp,stats['axis'])
+        
+        stats['n']+=1
+        delta=x-stats['mean']
+        stats['mean']=stats['mean']+delta/stats['n']
+        stats['M2']=stats['M2']+delta*(x-stats['mean'])
+        self._runningStats=stats
+        self.setTDData(self._runningStatsTDData(mp))
+
+    def _alignTrace(self,tdData,peak,mp,axis):
+        #X and Y of a preprocessed trace with its peak at mp, interpolated to the common
+        #time axis given relative to mp as (start,end,length)
+        #(the end points may exceed the shifted trace by rounding errors, interp clamps them)
+        start,end,length=axis
+        times=tdData[:,0]-(peak-mp)
+        timeaxis=py.linspace(mp+start,mp+end,length)
+        return py.column_stack((py.interp(timeaxis,times,tdData[:,1]),
+                                py.interp(timeaxis,times,tdData[:,2])))
+
+    def _runningStatsTDData(self,mp):
+        #the tdData array (as calcTDData) from the running statistics
+        stats=self._runningStats
+        start,end,length=stats['axis']
+        if stats['n']==1:
+            rep=py.zeros((length,2))
+        else:
+            rep=py.sqrt(stats['M2']/(stats['n']-1))/py.sqrt(self.numberOfDataSets)
+        unc=py.sqrt(rep**2+stats['noise']**2)
+        timeaxis=py.linspace(mp+start,mp+end,length)
+        return py.column_stack((timeaxis,stats['mean'],unc))
+
+    def _setPeakPositions(self,peak_pos):
+        #sets the peak positions of the measurements, the time shifts relative to their mean
+        #and the time jitter, returns the mean peak position
+        peak_pos=py.asarray(peak_pos)
+        mp=py.mean(peak_pos)
+        self._peakPos=peak_pos
+        self.timeShifts=peak_pos-mp
+        self.timeJitter=py.std(peak_pos)
+        return mp
+
+    def _streamRawData(self,params,workers,pooltype,cache,membudget,spooldir=None):
+        #memory-bounded import and averaging: the files are imported and preprocessed in
+        #chunks, the rotated raw data is spooled to a temporary file, that _thzdata_raw maps,
+        #a second pass aligns the traces chunkwise and merges them into the running statistics
+        if self.ALIGN_MODE=='xcorr':
+            raise ValueError("ALIGN_MODE 'xcorr' needs all measurements at once, "
+                             "use 'upsample' or 'parabolic' with membudget")
+        N=self.numberOfDataSets
+        spool=tempfile.TemporaryFile(dir=spooldir)
+        lengthes=[]
+        peaks=[]
+        starts=[]
+        ends=[]
+        pos=0
+        chunk=1
+        while pos<N:
+            rawData=self._importrange(pos,min(pos+chunk,N),params,workers,pooltype,cache)
+            processed=self._preprocessRawData(rawData)
+            peak_pos=self._peakPositions(processed)
+            for i in range(len(rawData)):
+                spool.write(py.ascontiguousarray(rawData[i][:,:3],dtype=float).tobytes())
+                lengthes.append(len(rawData[i][:,0]))
+                starts.append(processed[i][0,0]-peak_pos[i])
+                ends.append(processed[i][-1,0]-peak_pos[i])
+            peaks.extend(peak_pos)
+            pos+=len(rawData)
+            del rawData,processed
+            chunk=self._streamChunkSize(max(lengthes),membudget)
+        
+        spool.flush()
+        rawData=np.memmap(spool,dtype=float,mode='c')
+        offsets=py.cumsum([0]+[3*L for L in lengthes])
+        self._thzdata_raw=[rawData[offsets[i]:offsets[i+1]].reshape(-1,3) for i in range(N)]
+        self._dataChanged()
+        if min(lengthes)!=max(lengthes):
+            print("Datalength of suceeding measurements not consistent, try to fix")
+        
+        mp=self._setPeakPositions(peaks)
+        axis=(max(starts),min(ends),min(lengthes))
+        stats={'n':0,
+               'mean':py.zeros((axis[2],2)),
+               'M2':py.zeros((axis[2],2)),
+               'peaks':list(peaks),
+               'axis':axis,
+               'noise':self._precNoiseLevel()}
+        for pos in range(0,N,chunk):
+            x=py.asarray([self._alignTrace(self._removeLinearDrift(self._thzdata_raw[i]),
+                                           peaks[i],mp,axis)
+                          for i in range(pos,min(pos+chunk,N))])
+            #merge the chunk into the statistics (Chan et al.)
+            n=x.shape[0]
+            mean=py.mean(x,axis=0)
+            delta=mean-stats['mean']
+            total=stats['n']+n
+            stats['M2']+=py.sum((x-mean)**2,axis=0)+delta**2*stats['n']*n/float(total)
+            stats['mean']+=delta*n/float(total)
+            stats['n']=total
+        self._runningStats=stats
+        self.setTDData(self._runningStatsTDData(mp))
+
+    def _streamChunkSize(self,length,membudget):
+        #the number of traces of length samples, that are processed at once within membudget
+        return max(1,int(membudget/(length*3*8*self.STREAM_OVERHEAD)))
+
+    def _initRunningStats(self,processedData):
+        #keeps the statistics of the processed measurements needed by addMeasurement
+        mp=py.mean(self._peakPos)
+        timeaxis=processedData[0][:,0]
+        mean=py.mean(processedData[:,:,1:3],axis=0)
+        self._runningStats={'n':processedData.shape[0],
+                            'mean':mean,
+                            'M2':py.sum((processedData[:,:,1:3]-mean)**2,axis=0),
+                            'peaks':list(self._peakPos),
+                            'axis':(timeaxis[0]-mp,timeaxis[-1]-mp,len(timeaxis)),
+                            'noise':self._precNoiseLevel()}
  
     def setTDData(self,tdData):
         #set the tdData, use this function! 
         self.tdData=tdData
+        self._dataChanged()
         #we lost some steps,this is why the mean occurs, maybe snd line is better?
         self.dt=abs(py.mean(tdData[10:20,0]-tdData[9:19,0]))       
 #        self.dt=(tdData[-1,0]-tdData[0,0])/len(tdData[:,0])
@@ -378,6 +700,21 @@ class THzTdData():
         commonMAX=min([thistdData[:,0].max() for thistdData in tdDatas])
         commonLENGTH=min([thistdData[:,0].shape[0] for thistdData in tdDatas])
         
+        if min(all_lengthes)==max(all_lengthes):
+            #interpolate all traces together, the same way as interp1d does
+            stack=py.asarray(tdDatas)
+            timeaxis=py.linspace(commonMIN,commonMAX,commonLENGTH)
+            ix=py.asarray([py.searchsorted(times,timeaxis) for times in stack[:,:,0]])
+            ix=py.clip(ix,1,stack.shape[1]-1)
+            rows=py.arange(stack.shape[0])[:,py.newaxis]
+            t_lo=stack[rows,ix-1,0]
+            t_hi=stack[rows,ix,0]
+            y_lo=stack[rows,ix-1,1:]
+            y_hi=stack[rows,ix,1:]
+            slope=(y_hi-y_lo)/(t_hi-t_lo)[:,:,py.newaxis]
+            longerData=slope*(timeaxis-t_lo)[:,:,py.newaxis]+y_lo
+            return py.concatenate((py.tile(timeaxis,(stack.shape[0],1))[:,:,py.newaxis],longerData),axis=2)
+        
         #interpolate the data
         for i in range(self.numberOfDataSets):
             tdDatas[i]=self.getInterData(tdDatas[i],commonLENGTH,commonMIN,commonMAX)
@@ -394,29 +731,233 @@ class THzTdData():
         YCs=rawtdData[max(0,ix_max-no):min(rawtdData.shape[0],ix_max+no),2]
         return py.arctan(py.mean(YCs/XCs))
     
+    def _importrange(self,start,stop,params,workers=1,pooltype='thread',cache=None):
+        #imports the measurements start to stop-1 of self.filename
+        return self._importfiles(self.filename[start:stop],params,workers,pooltype,cache)
+
+    def _importfiles(self,filenames,params,workers=1,pooltype='thread',cache=None):
+        #imports all files with importfile, in parallel if workers>1, the order of filenames
+        #is kept, a failure raises an IOError naming the file
+        #files found in the cache are not parsed again
+        args=[(self,fname,params,cache) for fname in filenames]
+        if workers<=1 or len(filenames)<2:
+            return [_importWorker(arg) for arg in args]
+        
+        if pooltype=='process':
+            pool=Pool(workers)
+        else:
+            pool=ThreadPool(workers)
+        try:
+            return pool.map(_importWorker,args)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _parabolicPeak(self,y,ix,wrap=False):
+        #sub-sample position of the maxima at the indices ix along the last axis of y,
+        #by a parabola through the maximum and its two neighbours
+        #wrap=True takes the neighbours periodically (for circular data like a cross-correlation),
+        #otherwise maxima at the edges are moved inwards by one sample
+        rows=py.arange(y.shape[0])
+        M=y.shape[1]
+        if not wrap:
+            ix=py.clip(ix,1,M-2)
+        ym=y[rows,(ix-1)%M]
+        y0=y[rows,ix]
+        yp=y[rows,(ix+1)%M]
+        curv=ym-2*y0+yp
+        delta=py.where(curv!=0,0.5*(ym-yp)/py.where(curv!=0,curv,1),0)
+        return ix+delta
+
+    def _peakPositionsParabolic(self,tdDatas):
+        #peak times of the X channels from a parabolic fit around the maximum
+        if len(set([len(tdData[:,0]) for tdData in tdDatas]))>1:
+            return py.concatenate([self._peakPositionsParabolic([tdData]) for tdData in tdDatas])
+        stack=py.asarray(tdDatas)
+        pos=self._parabolicPeak(stack[:,:,1],py.argmax(stack[:,:,1],axis=1))
+        #linear interpolation of the time axis at the sub-sample position
+        ix=py.floor(pos).astype(int)
+        ix=py.clip(ix,0,stack.shape[1]-2)
+        rows=py.arange(stack.shape[0])
+        t_lo=stack[rows,ix,0]
+        return t_lo+(pos-ix)*(stack[rows,ix+1,0]-t_lo)
+
+    def _peakPositionsXcorr(self,tdDatas):
+        #delays of the X channels relative to their mean trace from the maximum of the fft
+        #cross-correlation, refined by a parabolic fit
+        if len(set([len(tdData[:,0]) for tdData in tdDatas]))>1:
+            #the mean trace is not defined, fall back to the single peaks
+            return self._peakPositionsParabolic(tdDatas)
+        stack=py.asarray(tdDatas)
+        N=stack.shape[1]
+        X=stack[:,:,1]-py.mean(stack[:,:,1],axis=1)[:,py.newaxis]
+        ref=py.mean(X,axis=0)
+        #zero padd to 2N to avoid the circular wrap around
+        cc=py.irfft(py.rfft(X,2*N,axis=1)*py.conj(py.rfft(ref,2*N)),2*N,axis=1)
+        lag=self._parabolicPeak(cc,py.argmax(cc,axis=1),wrap=True)
+        lag=py.where(lag>N,lag-2*N,lag)
+        dt=(stack[:,-1,0]-stack[:,0,0])/(N-1)
+        return stack[:,0,0]+lag*dt
+
+    def _peakPositions(self,tdDatas):
+        #the peak times of the X channels, determined as set by ALIGN_MODE
+        if self.ALIGN_MODE=='xcorr':
+            return self._peakPositionsXcorr(tdDatas)
+        if self.ALIGN_MODE=='parabolic':
+            return self._peakPositionsParabolic(tdDatas)
+        return self._peakPositionsUpsample(tdDatas)
+
+    def _peakPositionsUpsample(self,tdDatas,window=0.5e-12,factor=20):
+        #peak times of the X channels: the samples within +-window around the maximum are
+        #interpolated by a cubic spline to factor times as many points, the time of the largest
+        #of them is taken (as getShorterData and getInterData(...,'cubic') would do per trace)
+        if len(set([len(tdData[:,0]) for tdData in tdDatas]))>1:
+            return py.concatenate([self._peakPositionsUpsample([tdData],window,factor) for tdData in tdDatas])
+        stack=py.asarray(tdDatas)
+        times=stack[:,:,0]
+        rows=py.arange(stack.shape[0])
+        time_max_raw=times[rows,py.argmax(stack[:,:,1],axis=1)][:,py.newaxis]
+        inwindow=(times>=time_max_raw-window) & (times<time_max_raw+window)
+        counts=py.sum(inwindow,axis=1)
+        peak_pos=py.zeros(len(rows))
+        #the windows are cut to the same length L except at the edges of the traces,
+        #traces with equal L are interpolated together
+        for L in set(counts):
+            sel=rows[counts==L]
+            mask=inwindow[sel]
+            T=times[sel][mask].reshape(len(sel),L)
+            Y=stack[sel,:,1][mask].reshape(len(sel),L)
+            tfine=T[:,:1]+py.arange(factor*L)*((T[:,-1:]-T[:,:1])/(factor*L-1))
+            tfine[:,-1]=T[:,-1]
+            yfine=self._cubicSplineBatch(T,Y,tfine)
+            peak_pos[sel]=tfine[py.arange(len(sel)),py.argmax(yfine,axis=1)]
+        return peak_pos
+
+    def _cubicSplineBatch(self,x,y,xnew):
+        #evaluates the not-a-knot cubic splines through the rows of x,y (at least 4 points)
+        #at the rows of xnew, the spline interp1d(...,kind='cubic') uses
+        K,L=x.shape
+        #local coordinates in units of the mean sample spacing, for the conditioning
+        x0=x[:,:1]
+        scale=(x[:,-1:]-x0)/(L-1)
+        u=(x-x0)/scale
+        unew=(xnew-x0)/scale
+        h=py.diff(u,axis=1)
+        d=py.diff(y,axis=1)/h
+        #second derivatives M of the spline, interior rows are continuity of the slope,
+        #the first and last rows continuity of the third derivative at the second and
+        #second to last knot
+        A=py.zeros((K,L,L))
+        rhs=py.zeros((K,L))
+        i=py.arange(1,L-1)
+        A[:,i,i-1]=h[:,:-1]
+        A[:,i,i]=2*(h[:,:-1]+h[:,1:])
+        A[:,i,i+1]=h[:,1:]
+        rhs[:,1:-1]=6*(d[:,1:]-d[:,:-1])
+        A[:,0,0]=h[:,1]
+        A[:,0,1]=-(h[:,0]+h[:,1])
+        A[:,0,2]=h[:,0]
+        A[:,-1,-3]=h[:,-1]
+        A[:,-1,-2]=-(h[:,-2]+h[:,-1])
+        A[:,-1,-1]=h[:,-2]
+        M=np.linalg.solve(A,rhs[:,:,py.newaxis])[:,:,0]
+        #the interval of each new point
+        k=py.sum(u[:,py.newaxis,1:-1]<=unew[:,:,py.newaxis],axis=2)
+        r=py.arange(K)[:,py.newaxis]
+        hk=h[r,k]
+        a=(u[r,k+1]-unew)/hk
+        b=(unew-u[r,k])/hk
+        return a*y[r,k]+b*y[r,k+1]+((a**3-a)*M[r,k]+(b**3-b)*M[r,k+1])*hk**2/6
+
+    def _precNoiseLevel(self):
+        #the noise level used in calcTDData, the rms of the first sample of the preceeding
+        #noise of X and Y, taken from the first measurement (as getAllPrecNoise()[0])
+        return self.derivedCache.get('noiseLevel',self._calculatePrecNoiseLevel)
+
+    def _calculateAllPrecNoise(self,timePreceedingSignal=-1):
+        #the uncached getAllPrecNoise
+        precNoise=[self.getPreceedingNoise(tdData,timePreceedingSignal) for tdData in self._thzdata_raw]
+        return py.vstack(precNoise)
+
+    def _calculateDR(self):
+        #the uncached getDR
+        Emax=abs(self.getEX())
+        noise=self._precNoiseLevel()
+        return Emax/noise
+
+    def _calculatePeakPosition(self):
+        #the uncached getPeakPosition
+        return self.tdData[py.argmax(self.getEX()),0]
+
+    def _calculatePrecNoiseLevel(self):
+        #the uncached _precNoiseLevel
+        return py.sqrt(py.mean(self.getPreceedingNoise(self._thzdata_raw[0])[0]**2))
+
+    def _dataChanged(self):
+        #forgets the derived quantities, has to be called whenever tdData or the rawdata change
+        self.derivedCache.clear()
+        self._version+=1
+
     def _processRawData(self,tdDatas):
-        tempTDDatas=[]
-        for tdData in tdDatas:
-            #this rotates all signal to X, adds X and Y uncertainty to each
-            #tdData
-            t=self._rotateToXChannel(tdData)
-            #this removes Linear Drifts in X-Channel
-            t=self._removeLinearDrift(t)
-            
-            tempTDDatas.append(t)
+        #rotates, detrends and aligns the raw measurements and brings them to a common time axis
+        tempTDDatas=self._preprocessRawData(tdDatas)
 
         #before interpolating to a common time axis, this need to be a list of 
         #tdData arrays, since they might differ in length
         
         #first shift maxima on top, than interpolate, doesn't affect unc array
         tempTDDatas,time_jitter=self._removeTimeShift(tempTDDatas)
+        self.timeJitter=time_jitter
         #also uncertainty is interpolated
         tempTDDatas=self._bringToCommonTimeAxis(tempTDDatas)
         return tempTDDatas
 
+    def _preprocessRawData(self,tdDatas):
+        #rotates the raw measurements to the X channel and removes linear drifts,
+        #traces of equal length are stacked to a 3d array (traces x time x columns) and
+        #preprocessed together, only traces of different length are processed one by one
+        all_lengthes=[len(tdData[:,0]) for tdData in tdDatas]
+        batchlength=max(set(all_lengthes),key=all_lengthes.count)
+        batch=[i for i in range(len(tdDatas)) if all_lengthes[i]==batchlength]
+        
+        tempTDDatas=[None]*len(tdDatas)
+        if len(batch)>1:
+            stack=self._processRawStack(py.asarray([tdDatas[i] for i in batch]))
+            for j in range(len(batch)):
+                #the rawdata keeps the rotated X and Y channel, the entries of tdDatas are
+                #replaced, the arrays themselves stay unchanged
+                raw=tdDatas[batch[j]].copy()
+                raw[:,1:3]=stack[j,:,5:7]
+                tdDatas[batch[j]]=raw
+                tempTDDatas[batch[j]]=stack[j,:,:5]
+        
+        for i in range(len(tdDatas)):
+            if tempTDDatas[i] is not None:
+                continue
+            #this rotates all signal to X, adds X and Y uncertainty to each
+            #tdData
+            t=self._rotateToXChannel(tdDatas[i])
+            tdDatas[i]=t[:,:tdDatas[i].shape[1]]
+            #this removes Linear Drifts in X-Channel
+            t=self._removeLinearDrift(t)
+            
+            tempTDDatas[i]=t
+        return tempTDDatas
+
+    def _processRawStack(self,rawStack):
+        #the batched version of _rotateToXChannel and _removeLinearDrift for a 3d array of
+        #raw measurements of equal length,
+        #returns t,X,Y,uncX,uncY along with the rotated, not detrended X,Y (columns 5 and 6)
+        stack=self._rotateStackToXChannel(rawStack)
+        rotated=stack[:,:,1:3].copy()
+        stack[:,:,1:3]=signal.detrend(stack[:,:,1:3],axis=1)
+        return py.concatenate((stack,rotated),axis=2)
+
     def _removeLinearDrift(self,tdData):
         #do this for x and y channel?
         #overthink use of detrend here!
+        #returns the detrended copy
+        tdData=tdData.copy()
         tdData[:,1:3]=signal.detrend(tdData[:,1:3],axis=0)
         #take care in unsymmetric pulses: (hard 20 ?!)
 #        tdData[:,1:3]=tdData[:,1:3]-py.mean(tdData[:20,1:3])
@@ -426,64 +967,454 @@ class THzTdData():
         #not sure if needed, maybe we want to correct the rawdata by shifting the maxima on top of each other
         #the indices of the maxima        
         #takes at the moment only the X Channel data and corrects it (safer!)
-        peak_pos=[]
-        for tdData in tdDatas:
-            time_max_raw=tdData[py.argmax(tdData[:,1]),0]
-            thisPeakData=self.getShorterData(tdData,time_max_raw-0.5e-12,time_max_raw+0.5e-12)
-            thisPeakData=self.getInterData(thisPeakData,len(thisPeakData[:,0])*20,thisPeakData[0,0],thisPeakData[-1,0],'cubic')
-            peak_pos.append(thisPeakData[py.argmax(thisPeakData[:,1]),0])
-        
-        peak_pos=py.asarray(peak_pos)
-        mp=py.mean(peak_pos)
+        peak_pos=self._peakPositions(tdDatas)
+        mp=self._setPeakPositions(peak_pos)
         for i in range(len(tdDatas)):
             tdDatas[i][:,0]-=(peak_pos[i]-mp)
         return tdDatas,py.std(peak_pos)
 
+    def _rotateChannels(self,XC,YC,uX,uY,phase):
+        #rotates the X and Y channel by phase and propagates the (independent) uncertainties
+        #uX, uY of the samples, returns XC_new,YC_new,uXC_new,uYC_new
+        if self.UNC_BACKEND=='unumpy':
+            if unumpy is None:
+                raise ImportError("UNC_BACKEND 'unumpy' needs the uncertainties package")
+            ones=py.ones(XC.shape)
+            XC=unumpy.uarray(XC,uX*ones)
+            YC=unumpy.uarray(YC,uY*ones)
+            XC_new=XC*py.cos(phase)+YC*py.sin(phase)
+            YC_new=-XC*py.sin(phase)+YC*py.cos(phase)
+            return unumpy.nominal_values(XC_new),unumpy.nominal_values(YC_new),\
+                unumpy.std_devs(XC_new),unumpy.std_devs(YC_new)
+        
+        XC_new=XC*py.cos(phase)+YC*py.sin(phase)
+        YC_new=-XC*py.sin(phase)+YC*py.cos(phase)
+        #the uncertainty is the same for every sample of a trace
+        uXC_new=py.sqrt((uX*py.cos(phase))**2+(uY*py.sin(phase))**2)*py.ones(XC.shape)
+        uYC_new=py.sqrt((uX*py.sin(phase))**2+(uY*py.cos(phase))**2)*py.ones(XC.shape)
+        return XC_new,YC_new,uXC_new,uYC_new
+
     def _rotateToXChannel(self,tdData):
         #this function should remove all signal from Y-Channel
         
         #Calculate lock-in phase:
         unc_raw=self.getelnNoise(tdData)
-        XC=unumpy.uarray(tdData[:,1],unc_raw[0])
-        YC=unumpy.uarray(tdData[:,2],unc_raw[1])
         #go to pulse:
         phase=self._determineLockinPhase(tdData)
         
-        #rotate to XChannel
-        XC_new=XC*py.cos(phase)+YC*py.sin(phase)
-        YC_new=-XC*py.sin(phase)+YC*py.cos(phase)
-        tdData[:,1]=unumpy.nominal_values(XC_new)
-        tdData[:,2]=unumpy.nominal_values(YC_new)
+        #rotate to XChannel, in a copy of tdData
+        XC_new,YC_new,uXC_new,uYC_new=self._rotateChannels(tdData[:,1],tdData[:,2],unc_raw[0],unc_raw[1],phase)
+        tdData=tdData.copy()
+        tdData[:,1]=XC_new
+        tdData[:,2]=YC_new
         
-        unc_new=py.column_stack((unumpy.std_devs(XC_new),unumpy.std_devs(YC_new)))
+        unc_new=py.column_stack((uXC_new,uYC_new))
         tdData=py.column_stack((tdData,unc_new))
         return tdData
 
+    def _rotateStackToXChannel(self,rawStack):
+        #rotates a 3d array of raw measurements of equal length to the X channel, each with
+        #its own lock-in phase, returns the 3d array t,X,Y,uncX,uncY
+        unc_raw=self._stackElnNoise(rawStack)
+        phase=self._stackLockinPhase(rawStack)[:,py.newaxis]
         
+        #rotate to XChannel
+        rotated=self._rotateChannels(rawStack[:,:,1],rawStack[:,:,2],
+                                     unc_raw[:,0,py.newaxis],unc_raw[:,1,py.newaxis],phase)
+        return py.dstack((rawStack[:,:,0],)+tuple(rotated))
+
+    def _stackElnNoise(self,rawStack):
+        #the batched version of getelnNoise, returns a (traces x 2) array
+        times=rawStack[:,:,0]
+        starttime=times.min(axis=1)
+        nearestdistancetopeak=2.5e-12
+        if any(starttime-1>-nearestdistancetopeak):
+            #the time axis is unusual, let getPreceedingNoise handle it
+            return py.asarray([self.getelnNoise(tdData) for tdData in rawStack])
+        
+        #the noise is taken from the beginning up to half the position of the earlier extremum
+        earlier=py.minimum(py.argmax(rawStack[:,:,1],axis=1),py.argmin(rawStack[:,:,1],axis=1))
+        endtime=times[py.arange(len(times)),(earlier/2).astype(int)]
+        mask=(times>=starttime[:,py.newaxis]) & (times<endtime[:,py.newaxis])
+        lengthes=mask.sum(axis=1)
+        pos=py.arange(rawStack.shape[1])
+        if not py.array_equal(mask,pos<lengthes[:,py.newaxis]) or min(lengthes)<3:
+            #the noise is not a block at the beginning of each trace
+            return py.asarray([self.getelnNoise(tdData) for tdData in rawStack])
+        
+        #linear detrend of each noise block, weighted with the mask
+        w=mask[:,:,py.newaxis].astype(float)
+        x=pos[py.newaxis,:,py.newaxis]*w
+        y=rawStack[:,:,1:3]*w
+        S0=lengthes[:,py.newaxis].astype(float)
+        S1=x.sum(axis=1)
+        S2=(x**2).sum(axis=1)
+        Sy=y.sum(axis=1)
+        Sxy=(x*y).sum(axis=1)
+        slope=(S0*Sxy-S1*Sy)/(S0*S2-S1**2)
+        offset=(Sy-slope*S1)/S0
+        res=(y-offset[:,py.newaxis,:]*w-slope[:,py.newaxis,:]*x)
+        res-=res.sum(axis=1)[:,py.newaxis,:]/S0[:,py.newaxis,:]*w
+        std=py.sqrt((res**2).sum(axis=1)/(S0-1))
+        return std/py.sqrt(S0)
+
+    def _stackLockinPhase(self,rawStack):
+        #the batched version of _determineLockinPhase, returns one phase per trace
+        N=rawStack.shape[1]
+        no=4
+        ix_max=py.argmax(rawStack[:,:,1],axis=1)
+        ix=ix_max[:,py.newaxis]+py.arange(-no,no)
+        valid=(ix>=0) & (ix<N)
+        ix=py.clip(ix,0,N-1)
+        rows=py.arange(rawStack.shape[0])[:,py.newaxis]
+        ratio=rawStack[rows,ix,2]/rawStack[rows,ix,1]
+        return py.arctan(py.sum(ratio*valid,axis=1)/py.sum(valid,axis=1))
+
+class DerivedCache():
+    '''Memoizes quantities derived from the data of a THzTdData or FdData object
+    the owner clears it whenever its data changes, hits and misses count the lookups,
+    cached arrays are returned read-only, since they are shared between the callers
+    '''
+
+    def __init__(self):
+        self._values={}
+        self.hits=0
+        self.misses=0
+
+    def clear(self):
+        #forgets all values
+        self._values={}
+
+    def copy(self):
+        #a new cache, that starts with the values of this one
+        cache=DerivedCache()
+        cache._values=dict(self._values)
+        return cache
+
+    def get(self,key,func,*args):
+        #returns the value stored for key, on a miss it is calculated by func(*args)
+        if key in self._values:
+            self.hits+=1
+            return self._values[key]
+        self.misses+=1
+        value=func(*args)
+        if isinstance(value,np.ndarray):
+            value=value.view()
+            value.flags.writeable=False
+        self._values[key]=value
+        return value
+
+class ImportCache():
+    '''On-disk cache of parsed measurement files
+    the arrays returned by importfile are stored as .npy files in cachedir, keyed by
+    the path, size and modification time of the file, the params dict and the importer,
+    if the files in the cache exceed maxsize bytes, evict removes the least recently used ones,
+    store does not call it, THzTdData evicts once after importing all its files
+    '''
+    
+    def __init__(self,cachedir=None,maxsize=1e9):
+        if cachedir is None:
+            cachedir=os.path.join(os.path.expanduser('~'),'.terapy_cache')
+        self.cachedir=cachedir
+        self.maxsize=maxsize
+        self.hits=0
+        self.misses=0
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+    def clear(self):
+        #removes all files from the cache
+        for fname in self._cachefiles():
+            os.remove(fname)
+
+    def evict(self):
+        #removes the least recently used files until the cache is smaller than maxsize
+        files=[]
+        for fname in self._cachefiles():
+            try:
+                st=os.stat(fname)
+            except OSError:
+                continue
+            files.append((st.st_mtime,st.st_size,fname))
+        files.sort()
+        total=sum([size for mtime,size,fname in files])
+        while total>self.maxsize and len(files)>0:
+            mtime,size,fname=files.pop(0)
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+            total-=size
+
+    def getCachePath(self,fname,params,importer=''):
+        #the path of the cache file for fname, parsed with params by importer
+        st=os.stat(fname)
+        key=repr((os.path.abspath(fname),st.st_size,st.st_mtime,sorted(params.items()),importer))
+        return os.path.join(self.cachedir,hashlib.sha1(key.encode('utf-8')).hexdigest()+'.npy')
+
+    def load(self,fname,params,importer=''):
+        #returns the cached data of fname or None, if it is not (validly) cached
+        try:
+            path=self.getCachePath(fname,params,importer)
+            data=np.load(path)
+            #mark it as recently used
+            os.utime(path,None)
+        except (IOError,OSError,ValueError):
+            self.misses+=1
+            return None
+        self.hits+=1
+        return data
+
+    def store(self,fname,params,data,importer=''):
+        #writes data to the cache, the file is written under a temporary name first,
+        #such that concurrent readers never see half written files
+        path=self.getCachePath(fname,params,importer)
+        fd,tmppath=tempfile.mkstemp(suffix='.tmp',dir=self.cachedir)
+        try:
+            fobj=os.fdopen(fd,'wb')
+            try:
+                np.save(fobj,data)
+            finally:
+                fobj.close()
+            os.rename(tmppath,path)
+        except (IOError,OSError):
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+
+    def _cachefiles(self):
+        #all data files of the cache
+        return [os.path.join(self.cachedir,fname) for fname in os.listdir(self.cachedir)
+                if fname.endswith('.npy')]
+
+class TraceArchive():
+    '''Binary container of many traces of one measurement series
+    the file starts with MAGIC, followed by the chunks and a json trailer, the last bytes
+    hold the offset and size of the trailer and MAGIC again,
+    the trailer stores the shared time axis (relative to the first sample), the start time,
+    length and filename of every trace and the chunk index,
+    a chunk holds X and Y of up to chunksize consecutive traces as a (traces,points,2) array,
+    padded with nan to its longest trace and optionally zlib compressed,
+    the file is memory-mapped, so only the chunks of the requested traces are read
+    '''
+    MAGIC=b'THZTRCS1'
+    #trailer offset, trailer size, MAGIC
+    FOOTER='<QQ8s'
+
+    def __init__(self,archivename):
+        self.archivename=archivename
+        self._fobj=open(archivename,'rb')
+        try:
+            self._mm=mmap.mmap(self._fobj.fileno(),0,access=mmap.ACCESS_READ)
+        except (ValueError,EnvironmentError):
+            self._fobj.close()
+            raise IOError("File " + archivename + " is not a trace archive")
+        footsize=struct.calcsize(self.FOOTER)
+        if len(self._mm)<len(self.MAGIC)+footsize or self._mm[:len(self.MAGIC)]!=self.MAGIC:
+            self.close()
+            raise IOError("File " + archivename + " is not a trace archive")
+        offset,size,magic=struct.unpack(self.FOOTER,self._mm[-footsize:])
+        if magic!=self.MAGIC:
+            self.close()
+            raise IOError("Trace archive " + archivename + " was not closed properly")
+        trailer=json.loads(self._mm[offset:offset+size].decode('utf-8'))
+        self.dtype=np.dtype(str(trailer['dtype']))
+        self.compression=trailer['compression']
+        self.times=py.array(trailer['times'],dtype=float)
+        self.t0s=py.array(trailer['t0s'],dtype=float)
+        self.lengths=py.array(trailer['lengths'],dtype=int)
+        self.filenames=trailer['filenames']
+        #offset, size, first trace, number of traces and of points of every chunk
+        self.chunks=py.array(trailer['chunks'],dtype=np.int64).reshape(-1,5)
+
+    def close(self):
+        #releases the file, traces returned before stay valid
+        self._mm.close()
+        self._fobj.close()
+
+    def getFilenames(self,indices=None):
+        #the names of the original files of the traces
+        if indices is None:
+            indices=range(self.getLength())
+        return [self.filenames[i] or self.archivename+'['+str(i)+']' for i in indices]
+
+    def getLength(self):
+        #the number of traces in the archive
+        return len(self.lengths)
+
+    def getTrace(self,index):
+        #returns trace index as array t,X,Y
+        return self.getTraces([index])[0]
+
+    def getTraces(self,indices=None):
+        #returns the traces with the given indices (all if None) as list of arrays t,X,Y,
+        #every chunk containing one of them is read and decompressed only once
+        N=self.getLength()
+        if indices is None:
+            indices=range(N)
+        indices=py.asarray(indices,dtype=int).ravel()
+        if len(indices)>0 and (indices.min()<-N or indices.max()>=N):
+            raise IndexError("trace index out of range")
+        indices=indices%N
+        chunkix=py.searchsorted(self.chunks[:,2],indices,side='right')-1
+        traces=[None]*len(indices)
+        for c in py.unique(chunkix):
+            block=self._readChunk(c)
+            for j in py.where(chunkix==c)[0]:
+                i=indices[j]
+                L=self.lengths[i]
+                traces[j]=py.column_stack((self.t0s[i]+self.times[:L],
+                                           block[i-self.chunks[c,2],:L].astype(float)))
+        return traces
+
+    def _readChunk(self,c):
+        #the (traces,points,2) array of chunk c, uncompressed chunks are views on the file
+        offset,size,first,ntraces,npoints=[int(x) for x in self.chunks[c]]
+        count=ntraces*npoints*2
+        if self.compression=='zlib':
+            block=py.frombuffer(zlib.decompress(self._mm[offset:offset+size]),
+                                dtype=self.dtype,count=count)
+        else:
+            block=py.frombuffer(self._mm,dtype=self.dtype,count=count,offset=offset)
+        return block.reshape(ntraces,npoints,2)
+
+class TraceArchiveWriter():
+    '''Writes a TraceArchive trace by trace, so a series never has to be kept in memory
+    dtype='float32' halves the size, compression=None stores the chunks uncompressed,
+    the archive is only readable after close was called
+    '''
+    #the time axes of all traces have to agree within this fraction of the time step
+    TIME_TOLERANCE=1e-3
+
+    def __init__(self,archivename,dtype='float64',chunksize=64,compression='zlib',level=6):
+        if compression not in ('zlib',None):
+            raise ValueError("compression has to be 'zlib' or None")
+        self.archivename=archivename
+        #explicit byte order, such that archives are portable
+        self.dtype=np.dtype(dtype).newbyteorder('<')
+        self.chunksize=max(1,int(chunksize))
+        self.compression=compression
+        self.level=level
+        self._times=None
+        self._t0s=[]
+        self._lengths=[]
+        self._filenames=[]
+        self._chunks=[]
+        self._pending=[]
+        self._fobj=open(archivename,'wb')
+        self._fobj.write(TraceArchive.MAGIC)
+
+    def addTrace(self,tdData,filename=''):
+        #appends a trace (array t,X,Y)
+        tdData=py.asarray(tdData,dtype=float)
+        times=tdData[:,0]-tdData[0,0]
+        if self._times is None:
+            self._times=times
+        else:
+            n=min(len(times),len(self._times))
+            dt=abs(self._times[1]-self._times[0])
+            if not py.allclose(times[:n],self._times[:n],rtol=0,atol=self.TIME_TOLERANCE*dt):
+                raise ValueError("The time axis of " + str(filename) +
+                                 " differs from the time axis of the archive")
+            if len(times)>len(self._times):
+                self._times=times
+        self._t0s.append(float(tdData[0,0]))
+        self._lengths.append(len(times))
+        self._filenames.append(filename)
+        self._pending.append(tdData[:,1:3])
+        if len(self._pending)>=self.chunksize:
+            self._writeChunk()
+
+    def close(self):
+        #writes the last chunk and the trailer
+        if self._fobj is None:
+            return
+        self._writeChunk()
+        trailer={'version':1,
+                 'dtype':self.dtype.str,
+                 'compression':self.compression,
+                 'times':[] if self._times is None else self._times.tolist(),
+                 't0s':self._t0s,
+                 'lengths':self._lengths,
+                 'filenames':self._filenames,
+                 'chunks':self._chunks}
+        trailer=json.dumps(trailer).encode('utf-8')
+        offset=self._fobj.tell()
+        self._fobj.write(trailer)
+        self._fobj.write(struct.pack(TraceArchive.FOOTER,offset,len(trailer),TraceArchive.MAGIC))
+        self._fobj.close()
+        self._fobj=None
+
+    def _writeChunk(self):
+        #writes the pending traces as one chunk
+        if len(self._pending)==0:
+            return
+        npoints=max([len(x) for x in self._pending])
+        block=py.empty((len(self._pending),npoints,2),dtype=self.dtype)
+        block.fill(py.nan)
+        for k,x in enumerate(self._pending):
+            block[k,:len(x)]=x
+        data=block.tobytes()
+        if self.compression=='zlib':
+            data=zlib.compress(data,self.level)
+        offset=self._fobj.tell()
+        self._fobj.write(data)
+        first=len(self._lengths)-len(self._pending)
+        self._chunks.append([offset,len(data),first,len(self._pending),npoints])
+        self._pending=[]
+
 class ImportMarburgData(THzTdData):
     #only an example how a importer could look like,
     #in case of inrim and Marburg data, not really needed, (just define params)
-    def __init__(self,filename):
-       
-        params={'time_factor':1,
-                'time_col':0,
-                'X_col':1,
-                'Y_col':2,
-                'dec_sep':',',
-                'skiprows':0}    
-        THzTdData.__init__(self,filename,params)
+    PARAMS={'time_factor':1,
+            'time_col':0,
+            'X_col':1,
+            'Y_col':2,
+            'dec_sep':',',
+            'skiprows':0}
+
+    def __init__(self,filename,**kwargs):
+        THzTdData.__init__(self,filename,self.PARAMS,**kwargs)
         
 class ImportInrimData(THzTdData):
+    PARAMS={'time_factor':1,
+            'time_col':2,
+            'X_col':3,
+            'Y_col':5,
+            'dec_sep':'.',
+            'skiprows':0}
   
-    def __init__(self,filename):
-        params={'time_factor':1,
-                'time_col':2,
-                'X_col':3,
-                'Y_col':5,
-                'dec_sep':'.',
-                'skiprows':0}    
-        THzTdData.__init__(self,filename,params)
-  
+    def __init__(self,filename,**kwargs):
+        THzTdData.__init__(self,filename,self.PARAMS,**kwargs)
+
+def convertToTraceArchive(filenames,archivename,params=THzTdData.PARAMS,**kwargs):
+    #converts the text measurement files to a TraceArchive, params is their fileformat
+    #(e.g. ImportInrimData.PARAMS), kwargs are passed to TraceArchiveWriter
+    writer=TraceArchiveWriter(archivename,**kwargs)
+    try:
+        for fname in filenames:
+            writer.addTrace(loadTextTrace(fname,params),fname)
+    except Exception:
+        writer.close()
+        os.remove(archivename)
+        raise
+    writer.close()
+
+class ImportArchiveData(THzTdData):
+    #imports the traces of a TraceArchive, indices selects a subset of them
+    def __init__(self,archivename,indices=None,**kwargs):
+        self.archive=TraceArchive(archivename)
+        try:
+            if indices is None:
+                indices=range(self.archive.getLength())
+            self._archiveIndices=list(indices)
+            THzTdData.__init__(self,self.archive.getFilenames(self._archiveIndices),{},**kwargs)
+        finally:
+            self.archive.close()
+
+    def _importrange(self,start,stop,params,workers=1,pooltype='thread',cache=None):
+        #the traces are read from the archive, not from the files
+        return self.archive.getTraces(self._archiveIndices[start:stop])
+
 
 class FdData():
     '''A general fourier data class
@@ -492,46 +1423,109 @@ class FdData():
     #Class variables, that restrict the accesible frequency data from 0 to 5 THz
     FMIN=0
     FMAX=5e12    
+    #how zeroPadd chooses the length of the padded tdData: 'exact' gives fbins as close as
+    #possible, 'fast' rounds up to the next length 2**a*3**b*5**c, that is fast to transform
+    #(the frequency bins are then a bit smaller than fbins)
+    ZEROPADD_MODE='exact'
+    #how the spectrum is calculated: 'fft' transforms the whole (zero padded) tdData and crops
+    #it to fbnds, 'zoom' evaluates it only at the multiples of fbins inside fbnds by a
+    #chirp-z transform, zeroPadd then only refines the frequency grid
+    FD_MODE='fft'
     
-    def __init__(self,tdData,fbins=-1,fbnds=[FMIN,FMAX]):
+    def __init__(self,tdData,fbins=-1,fbnds=[FMIN,FMAX],mode=None,withunc=True):
         #FdData is always attached to a TdData Object
+        #the uncertainty columns are only calculated on first access to getF*Unc(),
+        #withunc=False skips them entirely (they stay NaN)
         
         #the original _tdData object should be private and not accessed from outside
         #if you want to know it use FdData.getassTDData()
         self._tdData=tdData
+        self.withunc=withunc
+        #memoized quantities derived from fdData, see _derivedValue
+        self.derivedCache=DerivedCache()
+        self._tdVersion=tdData.getVersion()
         
-        #calculate the fft and store it to the fdData array
-        self.fdData=self._calculatefdData(self._tdData) 
+        if mode is None:
+            mode=self.FD_MODE
+        self.fdmode=mode
         
-        #crop it to user bounds fbnds (min freq, max freq) and maybe also to a 
-        #desired frequency step width fbins
-        self.resetfdData(fbins,fbnds)
+        if mode=='zoom':
+            #calculate the spectrum only where it is needed
+            self.setFDData(self._calculatefdDataZoom(self._tdData,fbins,fbnds))
+        else:
+            #calculate the fft and store it to the fdData array
+            self.setFDData(self._calculatefdData(self._tdData))
+            
+            #crop it to user bounds fbnds (min freq, max freq) and maybe also to a 
+            #desired frequency step width fbins
+            self.resetfdData(fbins,fbnds)
         self.maxDR=max(self.getDR())
 
     def _calculatefdData(self,tdData):
         #no need to copy it before (access member variable is ugly but shorter)
 
-        #calculate the fft of the X channel
-        fd=py.fft(tdData.getEX())
+        #calculate the fft of the X channel, only the positive frequencies are needed,
+        #for even lengths the last bin of rfft is the nyquist frequency, that belongs to the
+        #negative frequencies of fftfreq
+        N=tdData.num_points
+        fd=py.rfft(tdData.getEX())
+        if N%2==0:
+            fd=fd[:-1]
         #calculate absolute and phase values
         fdabs=abs(fd)
         fdph=abs(py.unwrap(py.angle(fd)))
-        #calculate frequency axis
-        dfreq=py.fftfreq(tdData.num_points,tdData.dt)
+        #calculate frequency axis (as fftfreq)
+        dfreq=py.arange(len(fd))*(1.0/(N*tdData.dt))
         #extrapolate phase to 0 and 0 frequency
         fdph=self.removePhaseOffset(dfreq,fdph)
-        #set up the fdData array
+        #set up the fdData array, the uncertainty columns are filled in by _ensureUnc
         t=py.column_stack((dfreq,fd.real,fd.imag,fdabs,fdph))
-        
-        #this is so not nice!
-        self.fdData=t
+        t=self.getcroppedData(t)
+        return self._withUncPlaceholder(t,tdData)
+
+    def _calculatefdDataZoom(self,tdData,fbins,fbnds):
+        #the fdData array at the frequencies k*fbins inside fbnds (and FMIN, FMAX), fbins<=0
+        #means the resolution of the unpadded fft
+        if fbins<=0:
+            fbins=1.0/(tdData.num_points*tdData.dt)
+        fmin=max(fbnds[0],FdData.FMIN)
+        fmax=min(fbnds[1],FdData.FMAX)
+        kmin=int(py.ceil(fmin/fbins-1e-9))
+        kmax=int(py.floor(fmax/fbins+1e-9))
+        freqs=py.arange(kmin,kmax+1)*fbins
+        fd=_chirpz(tdData.getEX(),freqs[0],fbins,len(freqs),tdData.dt)
+        fdabs=abs(fd)
+        fdph=py.unwrap(py.angle(fd))
+        #unwrap starts at fmin, not at 0 like the fft, bring the phase to the branch, that
+        #the delay of the pulse suggests, such that abs gives the same as in the fft case
+        tau=tdData.getPeakPosition()-tdData.getTimes()[0]
+        fdph+=2*py.pi*py.rint((-2*py.pi*freqs[0]*tau-fdph[0])/(2*py.pi))
+        fdph=self.removePhaseOffset(freqs,abs(fdph))
+        t=py.column_stack((freqs,fd.real,fd.imag,fdabs,fdph))
+        return self._withUncPlaceholder(t,tdData)
+
+    def _withUncPlaceholder(self,t,tdData):
+        #appends NaN uncertainty columns to t and keeps what calculateFDunc needs from tdData,
+        #the tdData may be changed (shifted, windowed) before the uncertainties are requested
+        if self.withunc:
+            self._uncInputs=(tdData.getTimes().copy(),tdData.getUncEX().copy(),tdData.dt)
+        return py.column_stack((t,py.zeros((t.shape[0],4))*py.nan))
+
+    def _ensureUnc(self):
+        #calculates the uncertainty columns of fdData if they are not there yet
+        if not self.withunc or not py.isnan(self.fdData[:,5:]).any():
+            return
         unc=self.calculateFDunc()
-        t=self.getcroppedData(t,0,unc[-1,0])
-        
-        #interpolate uncertainty        
-        intpunc=interp1d(unc[:,0],unc[:,1:],axis=0)        
-        unc=intpunc(t[:,0])
-        return py.column_stack((t,unc))
+        intpunc=interp1d(unc[:,0],unc[:,1:],axis=0)
+        #fdData may be shared with copies, don't change it in place
+        self.fdData=py.column_stack((self.fdData[:,:5],intpunc(self.fdData[:,0])))
+
+    def copy(self):
+        #a new FdData with the same data, fdData and the tdData object are shared, since
+        #they are never changed in place, the memoized values are copied along
+        new=copy.copy(self)
+        new.derivedCache=self.derivedCache.copy()
+        return new
 
     def calculateFDunc(self):
         #Calculates the uncertainty of the FFT according to:
@@ -541,17 +1535,16 @@ class FdData():
         #samples
 
         # Calculates uncertainty of the real and imaginary part of the FFT and ther covariance
-        unc_E_real = []
-        unc_E_imag = []
-        cov = []
-        for f in self.getfreqs():
-            unc_E_real.append(py.sum((py.cos(2*py.pi*f*self._tdData.getTimes())*self._tdData.getUncEX())**2))
-            unc_E_imag.append(py.sum((py.sin(2*py.pi*f*self._tdData.getTimes())*self._tdData.getUncEX())**2))
-            cov.append(-0.5*sum(py.sin(4*py.pi*f*self._tdData.getTimes())*self._tdData.getUncEX()**2))
-        
-        unc_E_real = py.sqrt(py.asarray(unc_E_real))
-        unc_E_imag = py.sqrt(py.asarray(unc_E_imag))
-        cov = py.asarray(cov)
+        #the sums of cos**2, sin**2 and sin*cos weighted by uncEX**2 are written as one transform
+        #of uncEX**2 at 0 and 2f: cos**2=(1+cos(4pi f t))/2, sin**2=(1-cos(4pi f t))/2
+        times,uncEX,dt=self._uncInputs
+        u2=uncEX**2
+        C=_calculateDFT(u2,2*self.getfreqs(),times,dt)
+        #the sin terms vanish exactly at f=0, don't let rounding leak in there
+        C[self.getfreqs()==0]=py.sum(u2)
+        unc_E_real = py.sqrt(py.maximum(0.5*(py.sum(u2)+C.real),0))
+        unc_E_imag = py.sqrt(py.maximum(0.5*(py.sum(u2)-C.real),0))
+        cov = -0.5*C.imag
         
         # Calculates the uncertainty of the modulus and phase of the FFT
         unc_E_abs = py.sqrt((self.getFReal()**2*unc_E_real**2+self.getFImag()**2*unc_E_imag**2+2*self.getFReal()*self.getFImag()*cov)/self.getFAbs()**2)
@@ -574,11 +1567,9 @@ class FdData():
         #plot absolute and phase along with uncertainties
         f=1
 
-        uabs=unumpy.uarray(self.getFAbs(),self.getFAbsUnc())
         #scale the uncertainty for the 20*log10 plot
-        uabs=20*unumpy.log10(uabs)
-        u_a=unumpy.nominal_values(uabs)
-        u_s=unumpy.std_devs(uabs)
+        u_a=20*py.log10(self.getFAbs())
+        u_s=20/py.log(10)*self.getFAbsUnc()/self.getFAbs()
         
         py.figure('FD-ABS-UNC-Plot')
         py.plot(self.getfreqsGHz(),u_a)
@@ -665,7 +1656,11 @@ class FdData():
     def getBandwidth(self,dbDistancetoNoise=15):
         #this function should return the lowest trustable and highest trustable
         #frequency, along with the resulting bandwidth
-        
+        return self._derivedValue(('bandwidth',dbDistancetoNoise,self.maxDR),
+                                  self._calculateBandwidth,dbDistancetoNoise)
+
+    def _calculateBandwidth(self,dbDistancetoNoise=15):
+        #the uncached getBandwidth
         absdata=-20*py.log10(self.getFAbs()/max(self.getFAbs()))
         ix=self.maxDR-dbDistancetoNoise>absdata #dangerous, due to sidelobes, there might be some high freq component!
         tfr=self.getfreqs()[ix]
@@ -679,6 +1674,10 @@ class FdData():
 
     def getDR(self):
         #this function should return the dynamic range
+        return self._derivedValue('DR',self._calculateDR)
+
+    def _calculateDR(self):
+        #the uncached getDR
         #this should be the noiselevel of the fft
         noiselevel=py.sqrt(py.mean(abs(py.fft(self._tdData.getAllPrecNoise()[0]))**2))
         #apply a moving average filter on log
@@ -691,7 +1690,10 @@ class FdData():
 
     def getEtalonSpacing(self):
         #this should return the frequency of the Etalon
-    
+        return self._derivedValue('etalon',self._calculateEtalonSpacing)
+
+    def _calculateEtalonSpacing(self):
+        #the uncached getEtalonSpacing
     
         #how to find a stable range!
         bw=self.getBandwidth()
@@ -728,16 +1730,20 @@ class FdData():
         return self.fdData[:,4]
     def getFRealUnc(self):
         #the uncertainty of the real part of the fft
+        self._ensureUnc()
         return self.fdData[:,5]
     def getFImagUnc(self):
         #the uncertainty of the imag part of the fft        
+        self._ensureUnc()
         return self.fdData[:,6]
     def getFAbsUnc(self):
         #the uncertainty of the absolute value
         #maybe the calculation can also be done here, since it is not needed often
+        self._ensureUnc()
         return self.fdData[:,7]
     def getFPhUnc(self):
         #the uncertainty of the phase value
+        self._ensureUnc()
         return self.fdData[:,8]
 
     def getfbins(self):
@@ -759,6 +1765,7 @@ class FdData():
         
         absdata=signal.savgol_filter(self.getFAbs(),N_min-N_min%2+1,order)
         phdata=signal.savgol_filter(self.getFAbs(),N_min-N_min%2+1,order)
+        self._ensureUnc()
        
         return py.column_stack((self.fdData[:,:3],absdata,phdata,self.fdData[:,5:]))
     
@@ -776,6 +1783,7 @@ class FdData():
         # '1:' for interpolating all data, '3' for only the absdata and so on 
         oldfreqs=self.getfreqs()
         newfreqs=py.arange(min(oldfreqs),max(oldfreqs),newfbins)
+        self._ensureUnc()
         
         interfdData=interp1d(oldfreqs,self.fdData[:,1:],strmode,axis=0)
         
@@ -807,6 +1815,7 @@ class FdData():
         one=py.ones((window_size-1)/2,)
         dataabs=py.concatenate((dataabs[0]*one,dataabs,dataabs[-1]*one))
         dataph=py.concatenate((dataph[0]*one,dataph,dataph[-1]*one))
+        self._ensureUnc()
         return py.column_stack((self.fdData[:,:3],dataabs,dataph,self.fdData[:,5:]))
     
     def getSNR(self):
@@ -816,6 +1825,9 @@ class FdData():
     def removePhaseOffset(self,freqs,ph,startfreq=200e9,endfreq=1e12):
         #cut phase to reasonable range:
         ph_c=self.getcroppedData(py.column_stack((freqs,ph)),startfreq,endfreq)
+        if len(ph_c)<2:
+            #the data doesn't cover the range, use all of it
+            ph_c=py.column_stack((freqs,ph))
         #determine the slope and the offset      
         p=py.polyfit(ph_c[:,0],ph_c[:,1],1)
         #return full phase-offset(croppedPhase)
@@ -834,6 +1846,9 @@ class FdData():
         minf_old=min(self.getfreqs())
         maxf_old=max(self.getfreqs())
         self._tdData=tdData        
+        if self.fdmode=='zoom':
+            self.setFDData(self._calculatefdDataZoom(self._tdData,fbins_old,[minf_old,maxf_old]))
+            return
         self.setFDData(self._calculatefdData(self._tdData))
         
         self.resetfdData(fbins_old,[minf_old,maxf_old])
@@ -841,21 +1856,131 @@ class FdData():
     def setFDData(self,fdData):
         #sets the fdData array, obsolete?
         self.fdData=fdData
+        self.derivedCache.clear()
 
     def setPhase(self,newPh):
         #sets the Phase, needed for example for removing offsets
         if len(newPh)!=self.getLength():
             print 'Setting phase not possible, wrong length'
         else:
-            self.fdData[:,4]=newPh
+            fdData=self.fdData.copy()
+            fdData[:,4]=newPh
+            self.setFDData(fdData)
+
+    def _derivedValue(self,key,func,*args):
+        #memoized func(*args), everything is recalculated if the tdData changed meanwhile
+        if self._tdData.getVersion()!=self._tdVersion:
+            self.derivedCache.clear()
+            self._tdVersion=self._tdData.getVersion()
+        return self.derivedCache.get(key,func,*args)
 
-    def zeroPadd(self,fbins):
-        #zero padd the underlying tdData such that the fbins afterwards are fbins
+    def zeroPadd(self,fbins,paddmode=None):
+        #zero padd the underlying tdData such that the fbins afterwards are fbins,
+        #paddmode overrides ZEROPADD_MODE, the padding is done on a copy of the tdData
+        if self.fdmode=='zoom':
+            #no padding needed, evaluate the spectrum on the finer grid
+            bnds=[min(self.getfreqs()),max(self.getfreqs())]
+            self.setFDData(self._calculatefdDataZoom(self._tdData,fbins,bnds))
+            return
+        if paddmode is None:
+            paddmode=self.ZEROPADD_MODE
         spac=1/self._tdData.dt/fbins
         actlen=self._tdData.getLength()
-        nozeros=py.ceil(spac-actlen)
+        if paddmode=='fast':
+            nozeros=_nextFastLen(max(py.ceil(spac),actlen))-actlen
+        else:
+            nozeros=py.ceil(spac-actlen)
+        self._tdData=self._tdData.copy()
         self._tdData.zeroPaddData(nozeros)
         #leave the old bnds in place
         bnds=[min(self.getfreqs()),max(self.getfreqs())]
         zpd=self._calculatefdData(self._tdData)
-        self.setFDData(self.getcroppedData(zpd,bnds[0],bnds[1]))
\ No newline at end of file
+        self.setFDData(self.getcroppedData(zpd,bnds[0],bnds[1]))
+
+class ReferenceLibrary():
+    '''Processed reference spectra, that are shared by many HMeas objects
+    the spectrum of a reference THzTdData is calculated once per frequency grid, together with
+    its uncertainty and bandwidth, HMeas(...,reflib=...) takes its reference spectra from here,
+    the library hands out shallow copies, that share the arrays and memoized values but can be
+    cropped without touching the library
+    '''
+
+    def __init__(self,mode=None,withunc=True):
+        #mode and withunc are passed to every FdData of the library
+        self.mode=mode
+        self.withunc=withunc
+        self._spectra={}
+        self.hits=0
+        self.misses=0
+
+    def clear(self):
+        #forgets all spectra
+        self._spectra={}
+
+    def getFdData(self,tdData,fbins=-1,fbnds=[FdData.FMIN,FdData.FMAX]):
+        #the spectrum of tdData, zero padded to fbins and cropped to fbnds
+        return self._lookup(tdData,('fd',fbins),fbnds,self._calculateFdData,tdData,fbins)
+
+    def getCommonFdData(self,tdData,clen,cmin,cmax,fbnds=[FdData.FMIN,FdData.FMAX]):
+        #the spectrum of tdData interpolated to clen points from cmin to cmax,
+        #as needed by HMeas._commonFreqSamRef, cropped to fbnds
+        return self._lookup(tdData,('common',clen,cmin,cmax),fbnds,
+                            self._calculateCommonFdData,tdData,clen,cmin,cmax)
+
+    def _lookup(self,tdData,key,fbnds,func,*args):
+        #the spectra are kept for the full frequency range, only the copies are cropped,
+        #the tdData is stored along, such that its id stays unique
+        key=(id(tdData),tdData.getVersion())+key
+        if key in self._spectra:
+            self.hits+=1
+            fd=self._spectra[key][1]
+        else:
+            self.misses+=1
+            fd=func(*args)
+            #process the reference completely once, the copies inherit the results
+            fd.getBandwidth()
+            fd._ensureUnc()
+            self._spectra[key]=(tdData,fd)
+        shared=fd.copy()
+        if fbnds[0]>FdData.FMIN or fbnds[1]<FdData.FMAX:
+            shared.setFDData(shared.getcroppedData(shared.fdData,fbnds[0],fbnds[1]))
+        return shared
+
+    def _calculateFdData(self,tdData,fbins):
+        return FdData(tdData,fbins,[FdData.FMIN,FdData.FMAX],self.mode,self.withunc)
+
+    def _calculateCommonFdData(self,tdData,clen,cmin,cmax):
+        tdnew=THzTdData(tdData.getInterData(tdData.tdData,clen,cmin,cmax),tdData.getfilename(),
+                        tdData._thzdata_raw,existing=True)
+        return FdData(tdnew,-1,[FdData.FMIN,FdData.FMAX],self.mode,self.withunc)
+
+def propagateComplexUnc(H,factors):
+    #uncertainty columns (real, imag, abs, phase) of a spectrum H=prod(z_k**p_k), factors is a
+    #list of (FdData, p_k), e.g. [(fdsam,1),(fdref,-1)] for H=sam/ref
+    Z=[fd.getFReal()+1j*fd.getFImag() for fd,p in factors]
+    UR=[fd.getFRealUnc() for fd,p in factors]
+    UI=[fd.getFImagUnc() for fd,p in factors]
+    #relative uncertainty of the absolute value and the phase uncertainty
+    UA=[fd.getFAbsUnc()/fd.getFAbs() for fd,p in factors]
+    UP=[fd.getFPhUnc() for fd,p in factors]
+    return propagateComplexUncArrays(H,Z,UR,UI,UA,UP,[p for fd,p in factors])
+
+def propagateComplexUncArrays(H,Z,UR,UI,UA,UP,P):
+    #the array version of propagateComplexUnc, Z,UR,UI,UA,UP are lists with the spectrum, the
+    #uncertainties of its real and imag part, the relative uncertainty of its absolute value
+    #and the phase uncertainty of every factor, P the exponents
+    #the arrays may have leading axes (e.g. (K,M) for K samples), they are broadcast against H
+    #and the last axis of the result holds the four uncertainties
+    #the factors are assumed to be uncorrelated, H is holomorphic in every z_k=a_k+1j*b_k, so
+    #dH/da_k=p_k*H/z_k and dH/db_k=1j*dH/da_k, all factors are handled at once
+    stack=lambda X: py.asarray(py.broadcast_arrays(H,*X)[1:])
+    Z,UR,UI,UA,UP=stack(Z),stack(UR),stack(UI),stack(UA),stack(UP)
+    P=py.asarray(P,dtype=float).reshape((-1,)+(1,)*H.ndim)
+    
+    D=P*H/Z
+    unc_real=py.sqrt(py.sum((D.real*UR)**2+(D.imag*UI)**2,axis=0))
+    unc_imag=py.sqrt(py.sum((D.imag*UR)**2+(D.real*UI)**2,axis=0))
+    #abs(H)=prod(abs(z_k)**p_k) and ph(H)=sum(p_k*ph(z_k))
+    unc_abs=abs(H)*py.sqrt(py.sum((P*UA)**2,axis=0))
+    unc_ph=py.sqrt(py.sum((P*UP)**2,axis=0))
+    return py.concatenate([u[...,py.newaxis] for u in (unc_real,unc_imag,unc_abs,unc_ph)],axis=-1)
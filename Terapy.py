@@ -1,34 +1,73 @@
 import pylab as py
 import glob
 import os
-from uncertainties import unumpy
+import time
 from scipy.interpolate import interp1d
 from scipy.constants import c
 from scipy.optimize import minimize
+from multiprocessing import Pool
 from TeraData import *
 
+def _initLWorker(analyzer):
+    #every worker process of the thickness search keeps its own copy of the analyzer
+    global _lworker
+    _lworker=analyzer
+
+def _calculatenWorker(args):
+    #calculates n for one thickness candidate inside a worker process
+    l,H=args
+    return _lworker.calculaten(H,l)
+
 class HMeas(FdData):
     '''Transfer function
     HMeas is a measured transferfunction, in inherits FdData, because it is only a special
     for of frequency domain data,
     some functions need to get overriden (i.e. calculateSTDunc,...)
     '''
-    def __init__(self,FDref,FDsam,disableCut=False):
+    #how sample and reference are brought to common frequencies if they don't match:
+    #'rebuild' interpolates both time traces to a common time axis and recalculates both
+    #spectra, 'spectrum' interpolates the existing sample spectrum and its uncertainties to the
+    #frequencies of the reference and corrects its phase for the different start times
+    RESAMPLE_MODE='rebuild'
+
+    def __init__(self,FDref,FDsam,disableCut=False,reflib=None,fdData=None,resample=None):
         #initialize the transferfunction with a reference and a sample measurement, 
         #both, FDref, FDsam are FdData objects
         #disableCut is normaly false, this means that H is calculated only inside the bandwidth
-        self.fdref=FDref
-        self.fdsam=FDsam
+        #reflib is a ReferenceLibrary, if passed, the zero padded or interpolated reference
+        #spectra are taken from it instead of recalculating them for every sample
+        #HMeas works on copies of FDref and FDsam, cropping or padding H leaves them unchanged
+        #fdData is an already calculated H array (see HMeasBatch), that is used as it is
+        #resample overrides RESAMPLE_MODE
+        self.fdref=FDref.copy()
+        self.fdsam=FDsam.copy()
+        self.reflib=reflib
+        if resample is None:
+            resample=self.RESAMPLE_MODE
+        self.resample=resample
+        #true if fdsam is already resampled to the frequencies and time origin of fdref
+        self._resampled=False
 
         #sam td_data is more reliable for example noise calculation
         self._tdData=FDsam.getassTDData()
+        self.fdmode=FDsam.fdmode
+        #the uncertainty of H needs the uncertainties of both spectra
+        self.withunc=FDref.withunc and FDsam.withunc
+        #memoized quantities derived from fdData
+        self.derivedCache=DerivedCache()
+        self._tdVersion=self._tdData.getVersion()
         
-        if not disableCut:
+        if fdData is not None:
+            #fdref and fdsam are cropped to the frequencies of the given H
+            self.fdref.setFDData(self.fdref.getcroppedData(self.fdref.fdData,fdData[0,0],fdData[-1,0]))
+            self.fdsam.setFDData(self.fdsam.getcroppedData(self.fdsam.fdData,fdData[0,0],fdData[-1,0]))
+            self.setFDData(fdData)
+        elif not disableCut:
             #standard: cut the fdData inbetween the trustable frequency region
             self.resetfdData()
         else:
             #use all frequencies
-            self.fdData=self.calculatefdData()
+            self.setFDData(self.calculatefdData())
         self.maxDR=max(self.getDR())
     
     def calculatefdData(self):
@@ -42,8 +81,8 @@ class HMeas(FdData):
             print(prob_str)
             self._commonFreqSamRef(prob_str)
         
-        #calculate the uncertainty of H_real and H_imag
-        H_unc=self.calculateFDunc()
+        #the uncertainty of H is calculated on first access, see _ensureUnc
+        H_unc=py.zeros((self.fdref.getLength(),4))*py.nan
 
         #phase
         H_ph=self.fdref.getFPh()-self.fdsam.getFPh()
@@ -53,41 +92,27 @@ class HMeas(FdData):
         return H    
 
     def calculateFDunc(self):  
-        #Calculates the uncertainty of the FFT according to:
-        #   - J. M. Fornies-Marquina, J. Letosa, M. Garcia-Garcia, J. M. Artacho, "Error Propagation for the transformation of time domain into frequency domain", IEEE Trans. Magn, Vol. 33, No. 2, March 1997, pp. 1456-1459
-        
-        # Calculate the uncertainty of the real and imaginary part of H
-        #x=[a,b,c,d]
-        dfda=lambda x: x[2]/(x[2]**2+x[3]**2)
-        dfdb=lambda x: x[3]/(x[2]**2+x[3]**2)
-        dfdc=lambda x: (x[0]*x[3]**2-x[0]*x[2]**2-2*x[1]*x[2]*x[3])/(x[2]**2+x[3]**2)**2
-        dfdd=lambda x: (x[1]*x[2]**2-x[1]*x[3]**2-2*x[0]*x[2]*x[3])/(x[2]**2+x[3]**2)**2
-        
-        dgda=lambda x: -x[3]/(x[2]**2+x[3]**2)
-        dgdb=lambda x: x[2]/(x[2]**2+x[3]**2)
-        dgdc=lambda x: -(x[1]*x[2]**2-x[1]*x[3]**2+2*x[0]*x[2]*x[3])/(x[2]**2+x[3]**2)**2
-        dgdd=lambda x: (x[0]*x[3]**2-x[0]*x[2]**2-2*x[1]*x[2]*x[3])/(x[2]**2+x[3]**2)**2
-        
-        ta=self.fdsam.getFReal()
-        tb=self.fdsam.getFImag()
-        tc=self.fdref.getFReal()
-        td=self.fdref.getFImag()
-        
-        H_unc_real2=(self.fdsam.getFRealUnc()*dfda(py.asarray([ta,tb,tc,td])))**2
-        H_unc_real2+=(self.fdsam.getFImagUnc()*dfdb(py.asarray([ta,tb,tc,td])))**2
-        H_unc_real2+=(self.fdref.getFRealUnc()*dfdc(py.asarray([ta,tb,tc,td])))**2
-        H_unc_real2+=(self.fdref.getFImagUnc()*dfdd(py.asarray([ta,tb,tc,td])))**2
-        
-        H_unc_imag2=(self.fdsam.getFRealUnc()*dgda(py.asarray([ta,tb,tc,td])))**2
-        H_unc_imag2+=(self.fdsam.getFImagUnc()*dgdb(py.asarray([ta,tb,tc,td])))**2
-        H_unc_imag2+=(self.fdref.getFRealUnc()*dgdc(py.asarray([ta,tb,tc,td])))**2
-        H_unc_imag2+=(self.fdref.getFImagUnc()*dgdd(py.asarray([ta,tb,tc,td])))**2
-        
-        # Calculate the uncertainty of the modulus and phase of H
-        H_uncabs = py.sqrt((self.fdsam.getFAbsUnc()/self.fdref.getFAbs())**2 + (self.fdsam.getFAbs()*self.fdref.getFAbsUnc())**2/self.fdref.getFAbs()**4)
-        H_uncph = py.sqrt(self.fdsam.getFPhUnc()**2 + self.fdref.getFPhUnc()**2)
-        
-        return py.column_stack((py.sqrt(H_unc_real2),py.sqrt(H_unc_imag2),H_uncabs,H_uncph))
+        #Calculates the uncertainty of H=sam/ref from the uncertainties of both spectra by
+        #linear propagation, see propagateComplexUnc
+        S=self.fdsam.getFReal()+1j*self.fdsam.getFImag()
+        R=self.fdref.getFReal()+1j*self.fdref.getFImag()
+        return propagateComplexUnc(S/R,[(self.fdsam,1),(self.fdref,-1)])
+
+    def _ensureUnc(self):
+        #calculates the uncertainty columns of H from fdref and fdsam if they are not there yet
+        if not self.withunc or not py.isnan(self.fdData[:,5:]).any():
+            return
+        intpunc=interp1d(self.fdref.getfreqs(),self.calculateFDunc(),axis=0)
+        #fdData may be shared with copies, don't change it in place
+        self.fdData=py.column_stack((self.fdData[:,:5],intpunc(self.fdData[:,0])))
+
+    def copy(self):
+        #a new HMeas with the same data, also the reference and sample spectra are copied,
+        #such that manipulateFDData on the copy leaves this one unchanged
+        new=FdData.copy(self)
+        new.fdref=self.fdref.copy()
+        new.fdsam=self.fdsam.copy()
+        return new
         
     def doPlot(self):
         #do the H-plots
@@ -141,7 +166,7 @@ class HMeas(FdData):
         self.fdref.setFDData(self.fdref.getcroppedData(self.fdref.fdData,fbnds[0],fbnds[1]))        
         self.fdsam.setFDData(self.fdsam.getcroppedData(self.fdsam.fdData,fbnds[0],fbnds[1]))
         
-        self.fdData=self.calculatefdData()
+        self.setFDData(self.calculatefdData())
 
     def resetfdData(self,fbins=-1,fbnds=[FdData.FMIN,FdData.FMAX]):
         #restricts the H to fbnds, and also zeropadds to fbins
@@ -151,8 +176,16 @@ class HMeas(FdData):
         
     def zeroPadd(self,fbins):
         #zeropadding of H
-        self.fdref.zeroPadd(fbins)
+        self._ensureUnc()
+        if self.reflib is not None:
+            bnds=[min(self.fdref.getfreqs()),max(self.fdref.getfreqs())]
+            self.fdref=self.reflib.getFdData(self.fdref.getassTDData(),fbins,bnds)
+        else:
+            self.fdref.zeroPadd(fbins)
         self.fdsam.zeroPadd(fbins)
+        self._tdData=self.fdsam.getassTDData()
+        #the padded spectra are calculated from the time traces again
+        self._resampled=False
         self.calculatefdData()
 
     def _checkDataIntegrity(self):
@@ -160,18 +193,20 @@ class HMeas(FdData):
         tdrefData=self.fdref.getassTDData()
         tdsamData=self.fdsam.getassTDData()
 
-        #begin and end of timeaxis should differ not more than 5 as
-        if abs(tdrefData.tdData[0,0]-tdsamData.tdData[0,0])>5e-15:
-            return 'td-Problem-phase'
+        #a resampled fdsam fits to fdref, although the time axes differ
+        if not self._resampled:
+            #begin and end of timeaxis should differ not more than 5 as
+            if abs(tdrefData.tdData[0,0]-tdsamData.tdData[0,0])>5e-15:
+                return 'td-Problem-phase'
 
-        #length of time axis should be identical
-        if tdrefData.getLength()!=tdsamData.getLength():
-            return 'td-Problem-len'
-        
-        
-        if abs(tdrefData.tdData[-1,0]-tdsamData.tdData[-1,0])>1e-16 or\
-            abs(tdrefData.tdData[0,0]-tdsamData.tdData[0,0])>1e-16:
-            return 'td-Problem-interval'
+            #length of time axis should be identical
+            if tdrefData.getLength()!=tdsamData.getLength():
+                return 'td-Problem-len'
+            
+            
+            if abs(tdrefData.tdData[-1,0]-tdsamData.tdData[-1,0])>1e-16 or\
+                abs(tdrefData.tdData[0,0]-tdsamData.tdData[0,0])>1e-16:
+                return 'td-Problem-interval'
         
         #length in frequency domain should be equal
         if self.fdref.getLength()!= self.fdsam.getLength():
@@ -184,8 +219,11 @@ class HMeas(FdData):
         return 'good'
       
     def _commonFreqSamRef(self,prob_str):
-        #take care, this actually manipulates the real underlying data!
-        #maybe consider to do a deepcopy!
+        #replaces fdref and fdsam by spectra on a common time axis, the tdData of the old
+        #ones stays unchanged, only copies are padded
+        if self.resample=='spectrum':
+            self._resampleSamToRef()
+            return
         tdref=self.fdref.getassTDData()
         tdsam=self.fdsam.getassTDData()
   
@@ -196,6 +234,7 @@ class HMeas(FdData):
             t_start_ref=tdref.tdData[0,0]
             t_start_sam=tdsam.tdData[0,0]
             N=int((t_start_sam-t_start_ref)/tdsam.dt)
+            tdsam=tdsam.copy()
             tdsam.zeroPaddData(N,'zero','start')
       
         #(max min notation for readability?
@@ -207,12 +246,127 @@ class HMeas(FdData):
         minrf,maxrf=self.fdref.getBandwidth()
         minsf,maxsf=self.fdsam.getBandwidth()
                 
-        tdrefnew=THzTdData(tdref.getInterData(tdref.tdData,clen,cmin,cmax),tdref.getfilename(),tdref._thzdata_raw,existing=True)
+        bnds=[min(minrf,minsf),max(maxrf,maxsf)]
         tdsamnew=THzTdData(tdsam.getInterData(tdsam.tdData,clen,cmin,cmax),tdsam.getfilename(),tdsam._thzdata_raw,existing=True)
+        if self.reflib is not None:
+            self.fdref=self.reflib.getCommonFdData(tdref,clen,cmin,cmax,bnds)
+        else:
+            tdrefnew=THzTdData(tdref.getInterData(tdref.tdData,clen,cmin,cmax),tdref.getfilename(),tdref._thzdata_raw,existing=True)
+            self.fdref=FdData(tdrefnew,-1,bnds,withunc=self.withunc)
+        self.fdsam=FdData(tdsamnew,-1,bnds,withunc=self.withunc)  
+        self._tdData=tdsamnew
+
+    def _resampleSamToRef(self):
+        #maps the sample spectrum and its uncertainties onto the frequencies of the reference,
+        #the phase is referred to the start time of the reference, no fft is recalculated
+        tdref=self.fdref.getassTDData()
+        tdsam=self.fdsam.getassTDData()
+        self.fdsam._ensureUnc()
+        samfreqs=self.fdsam.getfreqs()
+        ref=self.fdref.getcroppedData(self.fdref.fdData,min(samfreqs),max(samfreqs))
+        freqs=ref[:,0]
         
-        self.fdref=FdData(tdrefnew,-1,[min(minrf,minsf),max(maxrf,maxsf)])
-        self.fdsam=FdData(tdsamnew,-1,[min(minrf,minsf),max(maxrf,maxsf)])  
+        #absolute value and unwrapped phase vary much slower than real and imaginary part
+        S=self.fdsam.getFReal()+1j*self.fdsam.getFImag()
+        intp=interp1d(samfreqs,py.column_stack((abs(S),py.unwrap(py.angle(S)),self.fdsam.fdData[:,5:])),axis=0)
+        samabs,samph,ure,uim,uabs,uph=intp(freqs).T
+        #a later start of the sample time axis is a delay relative to the reference
+        shift=2*py.pi*freqs*(tdsam.tdData[0,0]-tdref.tdData[0,0])
+        samph-=shift
+        S=samabs*py.exp(1j*samph)
+        #the phase column as in FdData._calculatefdData
+        fdph=self.fdsam.removePhaseOffset(freqs,abs(samph))
+        #the rotation by shift mixes the uncertainties of real and imaginary part
+        cs=py.cos(shift)
+        sn=py.sin(shift)
+        ure,uim=py.sqrt((cs*ure)**2+(sn*uim)**2),py.sqrt((sn*ure)**2+(cs*uim)**2)
         
+        self.fdref.setFDData(ref)
+        self.fdsam.setFDData(py.column_stack((freqs,S.real,S.imag,samabs,fdph,ure,uim,uabs,uph)))
+        self._resampled=True
+        
+class HMeasBatch():
+    '''Transfer functions of many samples against one reference
+    the sample spectra have to be on the frequency grid of the reference, then all K transfer
+    functions and their uncertainties are calculated at once as (K,M) arrays,
+    getHMeas(k) returns the HMeas object of the k-th sample, that can be passed to teralyz,
+    its fdData is a view into fdDatas
+    '''
+    #maximum deviation of the frequency axes in Hz, as in HMeas._checkDataIntegrity
+    FREQ_TOLERANCE=1e6
+
+    def __init__(self,FDref,FDsams,disableCut=False):
+        #FDref is the FdData of the reference, FDsams a list of sample FdData objects,
+        #disableCut as in HMeas, if it is false every HMeas is cut to its own bandwidth
+        self.fdref=FDref.copy()
+        self.fdsams=[FDsam.copy() for FDsam in FDsams]
+        self.disableCut=disableCut
+        self.withunc=FDref.withunc and all(fd.withunc for fd in FDsams)
+        self._checkDataIntegrity()
+        self.fdDatas=self.calculatefdDatas()
+
+    def calculatefdDatas(self):
+        #the (K,M,9) array of the K transfer functions, columns as in HMeas.fdData
+        R=self.fdref.getFReal()+1j*self.fdref.getFImag()
+        S=py.asarray([fd.getFReal()+1j*fd.getFImag() for fd in self.fdsams])
+        H=S/R
+        H_ph=self.fdref.getFPh()-py.asarray([fd.getFPh() for fd in self.fdsams])
+        freqs=py.ones(H.shape)*self.fdref.getfreqs()
+        H_unc=py.zeros(H.shape+(4,))*py.nan
+        if self.withunc:
+            H_unc=self.calculateFDunc(H)
+        return py.concatenate((py.dstack((freqs,H.real,H.imag,abs(H),H_ph)),H_unc),axis=2)
+
+    def calculateFDunc(self,H):
+        #the (K,M,4) uncertainties of the transfer functions H, see propagateComplexUnc
+        ref=self.fdref
+        sams=self.fdsams
+        return propagateComplexUncArrays(H,
+            [py.asarray([fd.getFReal()+1j*fd.getFImag() for fd in sams]),ref.getFReal()+1j*ref.getFImag()],
+            [py.asarray([fd.getFRealUnc() for fd in sams]),ref.getFRealUnc()],
+            [py.asarray([fd.getFImagUnc() for fd in sams]),ref.getFImagUnc()],
+            [py.asarray([fd.getFAbsUnc()/fd.getFAbs() for fd in sams]),ref.getFAbsUnc()/ref.getFAbs()],
+            [py.asarray([fd.getFPhUnc() for fd in sams]),ref.getFPhUnc()],
+            [1,-1])
+
+    def getfreqs(self):
+        #the common frequency axis
+        return self.fdref.getfreqs()
+
+    def getHMeas(self,k):
+        #the transferfunction of the k-th sample as HMeas object
+        fdData=self.fdDatas[k]
+        if not self.disableCut:
+            #as HMeas.resetfdData, the bandwidth of the reference is only determined once
+            minrf,maxrf=self.fdref.getBandwidth()
+            minsf,maxsf=self.fdsams[k].getBandwidth()
+            freqs=self.getfreqs()
+            lo=py.searchsorted(freqs,max(minrf,minsf,FdData.FMIN),'left')
+            hi=py.searchsorted(freqs,min(maxrf,maxsf,FdData.FMAX),'right')
+            fdData=fdData[lo:hi]
+        return HMeas(self.fdref,self.fdsams[k],fdData=fdData)
+
+    def getHMeasList(self):
+        #the HMeas objects of all samples
+        return [self.getHMeas(k) for k in range(self.getNumberOfSamples())]
+
+    def getNumberOfSamples(self):
+        #the number of sample measurements
+        return len(self.fdsams)
+
+    def _checkDataIntegrity(self):
+        #all sample spectra have to be on the frequency grid of the reference and their time
+        #axes have to start at the same time (see HMeas._checkDataIntegrity)
+        freqs=self.fdref.getfreqs()
+        tdref=self.fdref.getassTDData()
+        for fd in self.fdsams:
+            tdsam=fd.getassTDData()
+            if abs(tdref.tdData[0,0]-tdsam.tdData[0,0])>5e-15 or \
+                tdref.getLength()!=tdsam.getLength() or fd.getLength()!=len(freqs) or \
+                any(abs(fd.getfreqs()-freqs)>=self.FREQ_TOLERANCE):
+                raise ValueError("HMeasBatch needs the sample spectra on the frequency grid of the "
+                                 "reference, use HMeas for "+str(fd.getassTDData().getfilename()[0]))
+
 class teralyz():
     '''Finds the optical constants
     this class implements the solver, i.e. the length finding algorithm on the measurement
@@ -220,10 +374,29 @@ class teralyz():
     '''
     #refractive index of air
     n_0=1.00027-0.0000j
+    #calculatenBatched rejects steps where abs(dH/dn)<BATCHED_MINDERIV and hands every bin,
+    #whose squared residual stays above BATCHED_ERRTOL*abs(H)**2, over to the simplex minimization
+    BATCHED_ERRTOL=1e-6
+    BATCHED_MINDERIV=1e-8
 
-    def __init__(self,measurementdata,thickness=None):
+    def __init__(self,measurementdata,thickness=None,solver='nelder-mead',echomode='finite',
+                 headless=False,callback=None):
         #measurementdata should be an object of type HMeas
+        #solver selects how n is found for each frequency in calculaten:
+        #'nelder-mead' minimizes each frequency bin on its own,
+        #'batched' solves all bins at once with a damped Newton iteration
+        #echomode 'finite' takes only the fabry perot echos inside the time window into account,
+        #'infinite' sums up all of them
+        #headless=True keeps the thickness search free of plots and prints, every evaluation
+        #is collected in ltrace (see getLTrace, plotLTrace) and passed to
+        #callback(l,quasispace,totalvariation,elapsed time), if given
         self.H=measurementdata
+        self.solver=solver
+        self.echomode=echomode
+        self.headless=headless
+        self.callback=callback
+        self.ltrace=[]
+        self._ltraceStart=time.time()
         #H of only the first pulse        
         self.H_firstPuls=self.getHFirstPuls()
         
@@ -291,38 +464,43 @@ class teralyz():
         n = py.asarray(n)
         k = py.asarray(k)      
         
-        Asam = []
-        Aref = []
-        Bsam = []
-        Bref = []
-        for i in range(len(self.H.getfreqs())):
-            Asam.append((py.sum(py.imag(self.H.fdsam.getFAbs().tolist()[i]*py.exp(1j*2*py.pi*self.H.getfreqs().tolist()[i]*self.H.fdsam._tdData.getTimes()))*self.H.fdsam._tdData.getUncEX())**2))
-            Aref.append((py.sum(py.imag(self.H.fdref.getFAbs().tolist()[i]*py.exp(1j*2*py.pi*self.H.getfreqs().tolist()[i]*self.H.fdref._tdData.getTimes()))*self.H.fdref._tdData.getUncEX())**2))
-            Bsam.append((py.sum(py.real(self.H.fdsam.getFAbs().tolist()[i]*py.exp(1j*2*py.pi*self.H.getfreqs().tolist()[i]*self.H.fdsam._tdData.getTimes()))*self.H.fdsam._tdData.getUncEX())**2))
-            Bref.append((py.sum(py.real(self.H.fdref.getFAbs().tolist()[i]*py.exp(1j*2*py.pi*self.H.getfreqs().tolist()[i]*self.H.fdref._tdData.getTimes()))*self.H.fdref._tdData.getUncEX())**2))
+        freqs = self.H.getfreqs()
+        #the prefactor that is common to all the terms
+        K = c/(2*py.pi*freqs*l)
+        #the sums over the time axis are the transforms of the time domain uncertainty:
+        #sum(imag(|E|*exp(2j*pi*f*t))*u)=|E|*imag(sum(u*exp(2j*pi*f*t)))
+        Tsam = self.H.fdsam._tdData.calculateDFT(self.H.fdsam._tdData.getUncEX(),freqs)
+        Tref = self.H.fdref._tdData.calculateDFT(self.H.fdref._tdData.getUncEX(),freqs)
+        Asam = (self.H.fdsam.getFAbs()*Tsam.imag)**2
+        Aref = (self.H.fdref.getFAbs()*Tref.imag)**2
+        Bsam = (self.H.fdsam.getFAbs()*Tsam.real)**2
+        Bref = (self.H.fdref.getFAbs()*Tref.real)**2
         
         # Uncertainty on n
-        sn_Esam_2 = ((c/(2*py.pi*self.H.getfreqs()*l))**2 * py.asarray(Asam)/self.H.fdsam.getFAbs()**4)/self.H.fdsam._tdData.numberOfDataSets
-        sn_Eref_2 = ((c/(2*py.pi*self.H.getfreqs()*l))**2 * py.asarray(Aref)/self.H.fdref.getFAbs()**4)/self.H.fdref._tdData.numberOfDataSets
+        sn_Esam_2 = (K**2 * Asam/self.H.fdsam.getFAbs()**4)/self.H.fdsam._tdData.numberOfDataSets
+        sn_Eref_2 = (K**2 * Aref/self.H.fdref.getFAbs()**4)/self.H.fdref._tdData.numberOfDataSets
         sn_l_2 = ((n-self.n_0)*sigma_L/l)**2
         #sn_l_2_1 = (c*self.H.getFPh()/(2*py.pi*self.H.getfreqs()*l*l))**2 * sigma_L**2
         #sn_H_2 = (c/(2*py.pi*self.H.getfreqs()*l))**2 * self.H.getFPhUnc()**2
+        #the complex refractive index, the fresnel term and the fabry perot term are shared
+        nc = n-1j*k
+        FP = 1/(1-((nc-self.n_0)/(nc+self.n_0))**2*py.exp(-2*1j*nc*2*py.pi*freqs*l/c))
         fn_Theta = (n-self.n_0.real)*(1/py.cos(sigma_Theta*py.pi/180)-1)
-        fn_H = (c/(2*py.pi*self.H.getfreqs()*l))*py.absolute(-py.angle(4*(n-1j*k)*self.n_0/(n-1j*k+self.n_0)**2))
-        fn_FP = (c/(2*py.pi*self.H.getfreqs()*l))*py.absolute(-py.angle(1/(1-((n-1j*k-self.n_0)/(n-1j*k+self.n_0))**2*py.exp(-2*1j*(n-1j*k)*2*py.pi*self.H.getfreqs()*l/c))))
-        fn_n0 = abs(self.n_0.real - n_exact)*py.ones(len(self.H.getFPh()))
+        fn_H = K*py.absolute(-py.angle(4*nc*self.n_0/(nc+self.n_0)**2))
+        fn_FP = K*py.absolute(-py.angle(FP))
+        fn_n0 = abs(self.n_0.real - n_exact)*py.ones(len(freqs))
         u_n = py.sqrt(sn_l_2+sn_Esam_2+sn_Eref_2)+fn_Theta+fn_H+fn_FP+fn_n0
 
         # Uncertianty on k
-        sk_Esam_2 = ((c/(2*py.pi*self.H.getfreqs()*l))**2 *(Bsam/self.H.fdsam.getFAbs()**4 + ((n-self.n_0)/(n+self.n_0))**2 * sn_Esam_2/n**2))/self.H.fdsam._tdData.numberOfDataSets
-        sk_Eref_2 = ((c/(2*py.pi*self.H.getfreqs()*l))**2 *(Bref/self.H.fdref.getFAbs()**4 + ((n-self.n_0)/(n+self.n_0))**2 * sn_Eref_2/n**2))/self.H.fdref._tdData.numberOfDataSets
-        sk_l_2 = (k*sigma_L/l)**2 + (c*(n-self.n_0)/((n+self.n_0)*n*2*py.pi*self.H.getfreqs()*l))**2*sn_l_2
+        sk_Esam_2 = (K**2 *(Bsam/self.H.fdsam.getFAbs()**4 + ((n-self.n_0)/(n+self.n_0))**2 * sn_Esam_2/n**2))/self.H.fdsam._tdData.numberOfDataSets
+        sk_Eref_2 = (K**2 *(Bref/self.H.fdref.getFAbs()**4 + ((n-self.n_0)/(n+self.n_0))**2 * sn_Eref_2/n**2))/self.H.fdref._tdData.numberOfDataSets
+        sk_l_2 = (k*sigma_L/l)**2 + (K*(n-self.n_0)/((n+self.n_0)*n))**2*sn_l_2
         #sk_l_2_1 = ((c/(2*py.pi*self.H.getfreqs()*l*l))*py.log(self.H.getFAbs()*(n+self.n_0.real)**2/(4*n*self.n_0.real)))**2 * sigma_L**2
         #sk_H_2 = (-c/(2*py.pi*self.H.getfreqs()*l*self.H.getFAbs()))**2 * self.H.getFAbsUnc()**2
-        fk_Theta = k*(1/py.cos(sigma_Theta*py.pi/180)-1)+c*(n-self.n_0.real)*fn_Theta/(n*2*py.pi*self.H.getfreqs()*l*(n+self.n_0.real))
-        fk_H = (c/(2*py.pi*self.H.getfreqs()*l))*(py.log(py.absolute(n/(n-1j*k)*((n-1j*k+self.n_0.real)/(n+self.n_0.real))**2))+py.absolute(fn_H)*(n-self.n_0.real)/(n*(n+self.n_0.real)))
-        fk_FP = (c/(2*py.pi*self.H.getfreqs()*l))*(py.absolute(-py.log(py.absolute(1/(1-((n-1j*k-self.n_0)/(n-1j*k+self.n_0))**2*py.exp(-2*1j*(n-1j*k)*2*py.pi*self.H.getfreqs()*l/c)))))+py.absolute(fn_FP)*(n-self.n_0.real)/(n*(n+self.n_0.real)))
-        fk_n0 = (c/(2*py.pi*self.H.getfreqs()*l))*(n-self.n_0.real)*(self.n_0.real - n_exact)/(n*self.n_0.real)
+        fk_Theta = k*(1/py.cos(sigma_Theta*py.pi/180)-1)+K*(n-self.n_0.real)*fn_Theta/(n*(n+self.n_0.real))
+        fk_H = K*(py.log(py.absolute(n/nc*((nc+self.n_0.real)/(n+self.n_0.real))**2))+py.absolute(fn_H)*(n-self.n_0.real)/(n*(n+self.n_0.real)))
+        fk_FP = K*(py.absolute(-py.log(py.absolute(FP)))+py.absolute(fn_FP)*(n-self.n_0.real)/(n*(n+self.n_0.real)))
+        fk_n0 = K*(n-self.n_0.real)*(self.n_0.real - n_exact)/(n*self.n_0.real)
         u_k = py.sqrt(sk_l_2+sk_Esam_2+sk_Eref_2)+fk_Theta+fk_H+fk_FP+fk_n0
         
         # Convert n in epsilon Epsilon = Epsilon_1 + j Epsilon_2 = (n+jk)**2
@@ -335,8 +513,8 @@ class teralyz():
         
         # Calculate absorption coefficient
         # alpha = 4 * pi * k * f / c1
-        alpha = 4 * py.pi * k * self.H.getfreqs() / (100 * c)      # in cm^-1
-        u_alpha = 4 * py.pi * u_k * self.H.getfreqs() / (100 * c)  # in cm^-1
+        alpha = 4 * py.pi * k * freqs / (100 * c)      # in cm^-1
+        u_alpha = 4 * py.pi * u_k * freqs / (100 * c)  # in cm^-1
         
         # Calculate maximum measurable absorption coefficient according to
         # P. U. Jepsen and B. M. Fisher: "Dynamic Range in terahertz time-domain transmission and reflection spectroscopy", Optics Letters, Vol. 30, n. 1, pp. 29-31, Jan 2005
@@ -345,7 +523,7 @@ class teralyz():
         
         # Save results into a table accessible from outside
         self.n_with_unc=py.real(py.column_stack((
-        self.H.getfreqs(),                            # frequencies
+        freqs,                                        # frequencies
         n, k,                                         # real and imaginary part of n
         u_n, u_k,                                     # k=1 combined uncertainty on n and k
         py.sqrt(sn_l_2), py.sqrt(sn_Esam_2), py.sqrt(sn_Eref_2), fn_Theta, fn_H, fn_FP, fn_n0, # Uncertainty components of n due to thickness, H, sample misallignment, k<<<, Neglect FP, ref ind of air
@@ -362,12 +540,82 @@ class teralyz():
     
         #calculate the initial values
         inits=py.asarray(self.calculateinits(H,l))
+        #the inits are calculated on the frequency axis of self.H, use only as many as needed
+        inits=inits[:,:len(H[:,0])]
         
+        if self.solver=='batched':
+            res,vals=self.calculatenBatched(H,l,inits)
+        else:
+            res,vals=self.calculatenNelderMead(H,l,inits)
+        n=py.asarray(res)
+        #self.n is a 5xlengthf array, frequency,n_real,n_imag,n_smoothed_real,n_smoothed_imag
+        self.n=py.column_stack((H[:,0],n,n))
+        return n
+
+
+    def calculatenBatched(self,H,l,inits,maxiter=100,xtol=1e-10):
+        #solves H_theory(n)=H_measured for all frequency bins at once
+        #H_theory is analytic in the complex n, so the Jacobian of the two real equations is
+        #given by the complex derivative and a damped (Levenberg-Marquardt) Newton step is
+        #  dn=-conj(dH)*(H_theory-H_measured)/((1+lambda)*abs(dH)**2)
+        freqs=H[:,0]
+        Hm=H[:,1]+1j*H[:,2]
+        nc=inits[0]-1j*inits[1]
+        lam=py.ones(len(freqs))*1e-3
+        #bins that did not converge yet and bins that converged
+        active=py.ones(len(freqs),dtype=bool)
+        converged=py.zeros(len(freqs),dtype=bool)
+        H_t,dH=self.H_theoryJacobian(freqs,[nc.real,-nc.imag],l)
+        err=abs(H_t-Hm)**2
+        err0=err.copy()
+        for i in range(maxiter):
+            if not any(active):
+                break
+            ix=py.where(active)[0]
+            step=-py.conj(dH[ix])*(H_t[ix]-Hm[ix])/((1+lam[ix])*abs(dH[ix])**2)
+            nt=nc[ix]+step
+            Ht_t,dH_t=self.H_theoryJacobian(freqs[ix],[nt.real,-nt.imag],l)
+            err_t=abs(Ht_t-Hm[ix])**2
+            #accept the steps that strictly reduced the error and relax the damping there,
+            #increase the damping for the others, steps with a vanishing derivative (on the
+            #plateau of strong absorption H_theory is flat) are not trusted, neither are steps
+            #larger than n itself or than a quarter of the distance c/(f*l) to the next
+            #solution, that differs by 2pi in the phase of H_theory
+            maxstep=py.minimum(abs(nc[ix]),c/(4*freqs[ix]*l))
+            better=py.isfinite(err_t) & (err_t<err[ix]) & py.isfinite(step) & \
+                (abs(dH[ix])>self.BATCHED_MINDERIV) & (abs(step)<maxstep)
+            acc=ix[better]
+            nc[acc]=nt[better]
+            H_t[acc]=Ht_t[better]
+            dH[acc]=dH_t[better]
+            err[acc]=err_t[better]
+            lam[acc]/=10.0
+            lam[ix[~better]]*=10.0
+            #converged if the accepted step is negligible, the bins where the damping
+            #exploded are given up
+            done=better & (abs(step)<xtol*abs(nt))
+            converged[ix[done]]=True
+            active[ix[done | (lam[ix]>1e10)]]=False
+
+        #the bins that didn't converge, got worse, don't fit as well as the simplex
+        #minimization would or went over to the solution of another phase branch than the
+        #initial value, are handed over to the simplex minimization
+        n0=inits[0]-1j*inits[1]
+        left=py.where(~converged | ~py.isfinite(nc) | (err>err0) |
+                      (err>self.BATCHED_ERRTOL*abs(Hm)**2) |
+                      (abs(nc-n0)>c/(4*freqs*l)))[0]
+        #the number of bins solved by the simplex minimization, for diagnostics
+        self.batchedFallbacks=len(left)
+        if len(left)>0:
+            nc[left],err[left]=self.calculatenNelderMead(H[left],l,inits[:,left])
+        return nc,err
+
+    def calculatenNelderMead(self,H,l,inits):
+        #minimizes the deviation of H_theory to H_measured for each frequency separately
         res=[] #the array of refractive index
         vals=[] # the array of error function values
         bnds=((1,None),(0,None)) #not used at the moment, with SLSQP bnds can be introduced
         nums=len(H[:,0])
-        #minimize the deviation of H_theory to H_measured for each frequency
         for i in range(nums):
 #            t=minimize(self.error_func,[inits[0,i],inits[1,i]],args=(H[i,:2],l), method='SLSQP',\
 #            bounds=bnds, options={'ftol':1e-9,'maxiter':2000, 'disp': False})
@@ -375,21 +623,18 @@ class teralyz():
             options={'xtol': 1e-6,'disp':False})
             res.append(t.x[0]-1j*t.x[1])
             vals.append(t.fun)
-        n=py.asarray(res)
-        #self.n is a 5xlengthf array, frequency,n_real,n_imag,n_smoothed_real,n_smoothed_imag
-        self.n=py.column_stack((H[:,0],n,n))
-        return n
-
+        return py.asarray(res),py.asarray(vals)
         
-    def doCalculation(self,bool_findl=1,n_SVMAFS=5,bool_silent=0):
+    def doCalculation(self,bool_findl=1,n_SVMAFS=5,bool_silent=0,workers=1,gridpoints=0):
         #this function does the complete calculation
+        #workers and gridpoints are handed over to findLintelli
         #bandwidth
         bw=self.H.getBandwidth()
         #crop data
         self.H.manipulateFDData(-1,[bw[0]+50e9,bw[1]-200e9])
         #if l_opt shouldn't be calculated used bool_findl=False
         if bool_findl:
-            self.l_opt=self.findLintelli()
+            self.l_opt=self.findLintelli(workers,gridpoints)
 
         print('\033[92m\033[1m' + '  Use Sample Thickness: ' + str(self.l_opt*1e6) + ' micro m ' + '\033[0m')
 
@@ -411,6 +656,17 @@ class teralyz():
   
     def errorL(self,l,H):
         #the error function for the length finding minimization
+        qs,tv=self.evaluateL(l,H)
+        self._reportL(l,qs,tv)
+        return qs
+    
+    def error_func(self,n,H,l):
+        #the quadratic deviation of Htheroy and Hmeasuered, used for finding n
+        H_t=self.H_theory(H[0],n,l)
+        return (H_t.real-H[1])**2+(H_t.imag-H[2])**2
+    
+    def evaluateL(self,l,H):
+        #returns the quasi space and the total variation value for the thickness l
         
         #calculate n for the short transfer function H and the length l
         n_small=[self.calculaten(H,l)]
@@ -418,18 +674,14 @@ class teralyz():
         qs=self.QuasiSpace(n_small,H[1,0]-H[0,0],l)
         #evaluate the total variation value
         tv=self.totalVariation(n_small)
-        #plot them
-        py.plot(l,qs[0],'+')
-        py.plot(l,tv[0],'*')        
-        print("Currently evaluating length: "+ str(l[0]*1e6) + " TV Value " + str(tv[0]))
-        return qs[0]
+        return qs[0],tv[0]
     
-    def error_func(self,n,H,l):
-        #the quadratic deviation of Htheroy and Hmeasuered, used for finding n
-        H_t=self.H_theory(H[0],n,l)
-        return (H_t.real-H[1])**2+(H_t.imag-H[2])**2
-    
-    def findLintelli(self):
+    def findLintelli(self,workers=1,gridpoints=0,gridspan=0.1):
+        #finds the thickness by minimizing the quasi space value
+        #gridpoints=0 (and workers=1) uses a serial Nelder-Mead minimization, otherwise a bracket
+        #of gridpoints candidates +-gridspan*userthickness is evaluated with workers processes
+        #and successively refined around the best candidate
+        
         #find the frequency with the most amplitude
         fmax=self.H.fdref.getmaxfreq()
         
@@ -439,12 +691,23 @@ class teralyz():
         f_span=c/2*1/self.l_estimated*1/n #(this should be the length of the oscillation)
         #restrict H to only 5 oscillations
         H_small=self.H.getcroppedData(self.H.fdData,fmax-f_span*1,fmax+f_span*4)
-        py.figure(33)
+        #start a new trace of the evaluated thicknesses
+        self.ltrace=[]
+        self._ltraceStart=time.time()
+        if not self.headless:
+            py.figure(33)
+        if workers>1 or gridpoints>0:
+            return self._findLGrid(py.asarray(H_small),workers,max(gridpoints,4*workers,3),gridspan)
         #minimize quasispace/totalvariation value
         t=minimize(self.errorL,self.userthickness,args=((py.asarray(H_small),)),\
         method='Nelder-Mead', options={'xtol':1e-6,'disp': False})#, 'disp': False})
         return t.x[0]
 
+    def getLTrace(self):
+        #returns the evaluations of the last thickness search as array with the columns
+        #thickness, quasi space value, total variation value, elapsed time
+        return py.asarray(self.ltrace).reshape(-1,4)
+
     def getHFirstPuls(self):
         #returns the transferfunction of the timedomain data that corresponds to the first
         #pulse only
@@ -455,8 +718,9 @@ class teralyz():
         refdata.zeroPaddData(origlen-refdata.getLength())
         samdata.zeroPaddData(origlen-samdata.getLength())
         #calculate the fouriertransform
-        firstref=FdData(refdata)
-        firstsam=FdData(samdata)
+        #only H itself is needed, skip the uncertainties
+        firstref=FdData(refdata,withunc=False)
+        firstsam=FdData(samdata,withunc=False)
         #calculate the transferfunction for the first puls
         H_firstPuls=HMeas(firstref,firstsam,disableCut=True)
         
@@ -491,14 +755,34 @@ class teralyz():
         nc=n[0]-1j*n[1]
         r_as=(self.n_0-nc)/(self.n_0+nc)
        
-        FPE=0
         P=lambda tn: py.exp(-1j*l*freq*2*py.pi*tn/c)
-        for sumk in range(1,self.no_echos):
-            FPE+=((r_as**2)*(P(nc)**2))**sumk
+        Pn=P(nc)
+        FPE,dFPE=self._echoSum((r_as**2)*(Pn**2))
         
-        H=4*self.n_0*nc/(nc+self.n_0)**2*P((nc-self.n_0))*(1+FPE)
+        H=4*self.n_0*nc/(nc+self.n_0)**2*Pn*P(-self.n_0)*(1+FPE)
         return H
 
+    def H_theoryJacobian(self,freq,n,l):
+        #returns H_theory and its derivative with respect to the complex refractive index nc,
+        #the derivatives to n_real and n_imag are dH and -1j*dH
+        nc=n[0]-1j*n[1]
+        r_as=(self.n_0-nc)/(self.n_0+nc)
+        P=lambda tn: py.exp(-1j*l*freq*2*py.pi*tn/c)
+        beta=2*py.pi*freq*l/c
+        
+        #fabry perot term and its derivative with respect to q=r_as**2*P(nc)**2
+        Pn=P(nc)
+        q=(r_as**2)*(Pn**2)
+        FPE,dFPE=self._echoSum(q)
+        #dq/dnc=q*(2*dr_as/r_as-2j*beta)
+        dq=q*(-4*self.n_0/((self.n_0-nc)*(self.n_0+nc))-2j*beta)
+        
+        T=4*self.n_0*nc/(nc+self.n_0)**2
+        H=T*Pn*P(-self.n_0)*(1+FPE)
+        #logarithmic derivative of the three factors
+        dlogH=(self.n_0-nc)/(nc*(nc+self.n_0))-1j*beta+dFPE*dq/(1+FPE)
+        return H,H*dlogH
+
     def nestimatedTD(self,tdsam,tdref):
         #the time delay between sample and reference pulse is used to estimate n
         tmaxs=tdsam.getPeakPosition()
@@ -670,6 +954,15 @@ class teralyz():
         py.pcolor(N_R,N_I,py.log10(E_fu))
         py.colorbar()
 
+    def plotLTrace(self,figurenumber=33):
+        #plots the quasi space and total variation values of the last thickness search
+        trace=self.getLTrace()
+        py.figure(figurenumber)
+        py.plot(trace[:,0],trace[:,1],'+')
+        py.plot(trace[:,0],trace[:,2],'*')
+        py.xlabel('Thickness in m')
+        py.legend(('QuasiSpace','TotalVariation'))
+
     def plotInits(self,H,l,figurenumber=200):
         #plots the initial conditions
         inits=self.calculateinits(H,l)
@@ -683,22 +976,24 @@ class teralyz():
     
     def QuasiSpace(self,ns,df,ls):
         #evaluates the quasi space value
-        allqs=[]
+        #ns is a list of n arrays or a 2d array (candidates x frequencies), all candidates are
+        #evaluated at once
+        if len(set([len(n) for n in ns]))>1:
+            #arrays of different length can't be stacked
+            return py.asarray([self.QuasiSpace([n],df,ls)[0] for n in ns])
+        ns=py.atleast_2d(py.asarray(ns))
         #at the moment, the most easy method(everything else failed...)
         #get the mean absolute value of the complete spectrum. works best
-        for i in range(len(ns)):
-#            xvalues=py.fftfreq(len(ns[i]),df)*c/4
-
-            QSr=py.fft(ns[i].real-py.mean(ns[i].real))
-            QSi=py.fft(ns[i].imag-py.mean(ns[i].real))
-            #naive cut:
-            ix=range(3,int(len(QSr)/2-1))
-        
-            QSr=QSr[ix]
-            QSi=QSi[ix]
-            allqs.append(py.mean(abs(QSr))+py.mean(abs(QSi)))
+#        xvalues=py.fftfreq(ns.shape[1],df)*c/4
+        meanr=py.mean(ns.real,axis=1)[:,py.newaxis]
+        QSr=py.fft(ns.real-meanr,axis=1)
+        QSi=py.fft(ns.imag-meanr,axis=1)
+        #naive cut:
+        ix=range(3,int(ns.shape[1]/2-1))
         
-        return allqs
+        QSr=QSr[:,ix]
+        QSi=QSi[:,ix]
+        return py.mean(abs(QSr),axis=1)+py.mean(abs(QSi),axis=1)
 
     def saveResults(self,filename=None):
         #save the results to a file        
@@ -778,14 +1073,69 @@ class teralyz():
 
     def totalVariation(self,ns):
         #calculate the total variation value
-        allvs=[]
+        #ns is a list of n arrays or a 2d array (candidates x frequencies)
+        if len(set([len(n) for n in ns]))>1:
+            return py.asarray([self.totalVariation([n])[0] for n in ns])
+        ns=py.atleast_2d(py.asarray(ns))
+        return py.sum(abs(py.diff(ns.real,axis=1))+abs(py.diff(ns.imag,axis=1)),axis=1)
+
+    def _findLGrid(self,H,workers,gridpoints,gridspan,xtol=1e-6,maxrounds=50):
+        #evaluates a bracket of thickness candidates (in parallel, if workers>1) and zooms in on
+        #the best one until the candidates are closer than xtol
+        best=self.userthickness
+        halfwidth=gridspan*self.userthickness
+        pool=None
+        if workers>1:
+            pool=Pool(workers,initializer=_initLWorker,initargs=(self,))
+        try:
+            for i in range(maxrounds):
+                ls=py.linspace(best-halfwidth,best+halfwidth,gridpoints)
+                if pool is None:
+                    ns=[self.calculaten(H,l) for l in ls]
+                else:
+                    ns=pool.map(_calculatenWorker,[(l,H) for l in ls])
+                #score the whole sweep at once
+                qss=self.QuasiSpace(ns,H[1,0]-H[0,0],ls)
+                tvs=self.totalVariation(ns)
+                for l,qs,tv in zip(ls,qss,tvs):
+                    self._reportL(l,qs,tv)
+                
+                ix=py.argmin(qss)
+                best=ls[ix]
+                spacing=ls[1]-ls[0]
+                if spacing<xtol:
+                    break
+                #keep the width if the minimum is at the edge of the bracket, zoom in otherwise
+                if ix>0 and ix<gridpoints-1:
+                    halfwidth=spacing
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return best
+
+    def _reportL(self,l,qs,tv):
+        #record the quasi space and total variation value of the thickness l,
+        #plot and print them only if not headless
+        l=py.ravel(l)[0]
+        elapsed=time.time()-self._ltraceStart
+        self.ltrace.append((l,qs,tv,elapsed))
+        if self.callback is not None:
+            self.callback(l,qs,tv,elapsed)
+        if self.headless:
+            return
+        py.plot(l,qs,'+')
+        py.plot(l,tv,'*')        
+        print("Currently evaluating length: "+ str(l*1e6) + " TV Value " + str(tv))
+
+    def _echoSum(self,q):
+        #the fabry perot echos q+q**2+...+q**(no_echos-1) as geometric series, along with
+        #the derivative with respect to q, in 'infinite' echomode all echos are summed up
+        if self.echomode=='infinite':
+            return q/(1-q),1/(1-q)**2
         
-        for i in range(len(ns)):
-            tv1=0            
-            for dm in range(1,len(ns[i])):
-                tv1+=abs(ns[i][dm-1].real-ns[i][dm].real)+\
-                abs(ns[i][dm-1].imag-ns[i][dm].imag)
-            
-            allvs.append(tv1)
-            
-        return allvs
+        M=max(self.no_echos,1)
+        qM=q**(M-1)
+        FPE=q*(1-qM)/(1-q)
+        dFPE=(1-M*qM+(M-1)*qM*q)/(1-q)**2
+        return FPE,dFPE
@@ -34,11 +34,21 @@ parser.add_argument('--outname','-o',nargs='?',type=str,help='prefix output file
 parser.add_argument('--isample','-is',nargs='*',help='list of sample filenames')
 parser.add_argument('--ireference','-ir',nargs='*',help='list of reference filenames')
 parser.add_argument('--mode','-m',type=str,default='INRIM',choices=['INRIM','Marburg','lucastestformat'],help='format of the datafiles')
+parser.add_argument('--cachedir',type=str,help='cache the parsed files in this folder')
+parser.add_argument('--cachesize',type=float,default=1000,help='remove the least recently used files, if the cache exceeds this many MB')
+parser.add_argument('--membudget',type=float,help='average the files in chunks using about this many MB')
 parser.add_argument('--thickness','-t',type=float,help='sample thickness')
 parser.add_argument('--savePlots','-s',action='store_false',help='turn off saving TD and FD plots')
 parser.add_argument('--workpath','-w',type=str,default='./',help='specify a base folder')
 args = parser.parse_args()
 
+#reuse already parsed files, if a cache folder is given
+if args.cachedir is not None:
+    TeraData.THzTdData.IMPORT_CACHE=TeraData.ImportCache(args.cachedir,args.cachesize*1e6)
+#average long series chunkwise, keeping the raw data in a temporary file
+if args.membudget is not None:
+    TeraData.THzTdData.MEMBUDGET=args.membudget*1e6
+
 ireffiles=args.ireference
 isamfiles=args.isample
 mode=args.mode
@@ -17,21 +17,46 @@ parser.add_argument('--outname','-o',nargs='?',type=str,help='prefix output file
 
 #input arguments
 parser.add_argument('--mode','-m',type=str,default='INRIM',choices=['INRIM','Marburg','lucastestformat'],help='format of the datafiles')
+parser.add_argument('--cachedir',type=str,help='cache the parsed files in this folder')
+parser.add_argument('--cachesize',type=float,default=1000,help='remove the least recently used files, if the cache exceeds this many MB')
+parser.add_argument('--membudget',type=float,help='average the files in chunks using about this many MB')
 
 #solver arguments
 parser.add_argument('--thickness','-t',type=float,help='sample thickness')
+parser.add_argument('--workers',default=1,type=int,help='number of threads/processes for the file import and the thickness search')
+parser.add_argument('--gridpoints',default=0,type=int,help='thickness candidates per search round (0: serial Nelder-Mead)')
+parser.add_argument('--solver',type=str,default='nelder-mead',choices=['nelder-mead','batched'],help='solver used for n at each frequency')
 
 #switches
 parser.add_argument('--windowing',action='store_false',help='switch Data Windowing Off')
 parser.add_argument('--zeroPadding',action='store_true',help='Switch Zero Padding on')
+parser.add_argument('--fastPadding',action='store_true',help='zero padd to fast fft lengths (slightly finer frequency bins)')
+parser.add_argument('--zoom',action='store_true',help='calculate the spectra only from 0.2 to 3.2 THz by a chirp-z transform instead of zero padding')
+parser.add_argument('--resampleSpectra',action='store_true',help='bring mismatching sample and reference spectra to common frequencies by interpolating the sample spectrum instead of recalculating both')
 parser.add_argument('--calcLength',action='store_false',help='switch length calculation off')
 parser.add_argument('--NoSavePlots','-s',action='store_true',help='turn off saving plots')
 parser.add_argument('--silent',action='store_true',help='switch save results off')
 parser.add_argument('--noSVMAF',default=5,nargs='?',type=int,help='No of SVMAF iterations')
 parser.add_argument('--showPlots',action='store_true',help='Show plots')
+parser.add_argument('--headless',action='store_true',help='no plots and prints during the thickness search')
 
 args = parser.parse_args()
 
+#reuse already parsed files, if a cache folder is given
+if args.cachedir is not None:
+    TeraData.THzTdData.IMPORT_CACHE=TeraData.ImportCache(args.cachedir,args.cachesize*1e6)
+#average long series chunkwise, keeping the raw data in a temporary file
+if args.membudget is not None:
+    TeraData.THzTdData.MEMBUDGET=args.membudget*1e6
+
+#round the zero padding up to fast fft lengths
+if args.fastPadding:
+    TeraData.FdData.ZEROPADD_MODE='fast'
+
+#interpolate the sample spectrum, if sample and reference don't match
+if args.resampleSpectra:
+    Terapy.HMeas.RESAMPLE_MODE='spectrum'
+
 starttime=time.time()       #save the initial time
 ireffiles=args.ireference   #reference files list
 isamfiles=args.isample      #sample file list
@@ -62,16 +87,16 @@ if len(samfiles)==0:
         
 #use the appropriate importer
 if mode=='lucastestformat':
-    reftd=TeraData.THzTdData(reffiles)
-    samtd=TeraData.THzTdData(samfiles)
+    reftd=TeraData.THzTdData(reffiles,workers=args.workers)
+    samtd=TeraData.THzTdData(samfiles,workers=args.workers)
     
 if mode=='Marburg':
-    reftd=TeraData.ImportMarburgData(reffiles)
-    samtd=TeraData.ImportMarburgData(samfiles)
+    reftd=TeraData.ImportMarburgData(reffiles,workers=args.workers)
+    samtd=TeraData.ImportMarburgData(samfiles,workers=args.workers)
 
 if mode=='INRIM':
-    reftd=TeraData.ImportInrimData(reffiles)
-    samtd=TeraData.ImportInrimData(samfiles)
+    reftd=TeraData.ImportInrimData(reffiles,workers=args.workers)
+    samtd=TeraData.ImportInrimData(samfiles,workers=args.workers)
 
 #windowing of the data, Standard: yes
 if args.windowing:
@@ -79,23 +104,29 @@ if args.windowing:
     reftd.setTDData(reftd.getWindowedData(1e-12))
     samtd.setTDData(samtd.getWindowedData(1e-12))
     
-#initialize the fd_data objects        
-ref_fd=TeraData.FdData(reftd)
-sam_fd=TeraData.FdData(samtd)    
-
-#Zero padding of the data, Standard: no
-if args.zeroPadding:
-    ref_fd.zeroPadd(5e9)
-    sam_fd.zeroPadd(5e9)
+if args.zoom:
+    #evaluate the spectra only in the band used below, at the zero padding resolution
+    fbins=5e9 if args.zeroPadding else -1
+    ref_fd=TeraData.FdData(reftd,fbins,[200e9,3.2e12],'zoom')
+    sam_fd=TeraData.FdData(samtd,fbins,[200e9,3.2e12],'zoom')
+else:
+    #initialize the fd_data objects        
+    ref_fd=TeraData.FdData(reftd)
+    sam_fd=TeraData.FdData(samtd)    
+    
+    #Zero padding of the data, Standard: no
+    if args.zeroPadding:
+        ref_fd.zeroPadd(5e9)
+        sam_fd.zeroPadd(5e9)
 
 #calculate the transfer function
 mdata=Terapy.HMeas(ref_fd,sam_fd)
 #crop it
 mdata.manipulateFDData(-11e9,[200e9,3.2e12])
 #initialize the solver
-myana=Terapy.teralyz(mdata,thickness)
+myana=Terapy.teralyz(mdata,thickness,args.solver,headless=args.headless)
 #do the calculation
-myana.doCalculation(args.calcLength,args.noSVMAF,args.silent)
+myana.doCalculation(args.calcLength,args.noSVMAF,args.silent,args.workers,args.gridpoints)
 
 #do some plots
 if args.outname==None:
@@ -20,8 +20,18 @@ parser.add_argument('--ireference2','-ir2',nargs='*',help='list of reference fil
 parser.add_argument('--mode1','-m1',type=str,default='INRIM',choices=['INRIM','Marburg','lucastestformat'],help='format of the datafiles of dataset 1')
 parser.add_argument('--mode2','-m2',type=str,default='INRIM',choices=['INRIM','Marburg','lucastestformat'],help='format of the datafiles of dataset 2')
 parser.add_argument('--workpath','-w',type=str,default='',help='specify a base folder')
+parser.add_argument('--cachedir',type=str,help='cache the parsed files in this folder')
+parser.add_argument('--cachesize',type=float,default=1000,help='remove the least recently used files, if the cache exceeds this many MB')
+parser.add_argument('--membudget',type=float,help='average the files in chunks using about this many MB')
 args = parser.parse_args()
 
+#reuse already parsed files, if a cache folder is given
+if args.cachedir is not None:
+    TeraData.THzTdData.IMPORT_CACHE=TeraData.ImportCache(args.cachedir,args.cachesize*1e6)
+#average long series chunkwise, keeping the raw data in a temporary file
+if args.membudget is not None:
+    TeraData.THzTdData.MEMBUDGET=args.membudget*1e6
+
 ireffiles1=args.ireference1
 ireffiles2=args.ireference2
 mode1=args.mode1
@@ -66,9 +76,11 @@ elif mode2=='INRIM':
 ref_fd1=TeraData.FdData(reftd1)
 ref_fd2=TeraData.FdData(reftd2)
 
-#shift to same time!
-reftd1.tdData[:,0]-=reftd1.getPeakPosition()
-reftd2.tdData[:,0]-=reftd2.getPeakPosition()
+#shift to same time! (through setTDData, such that the derived quantities are updated)
+for reftd in [reftd1,reftd2]:
+    shifted=reftd.tdData.copy()
+    shifted[:,0]-=reftd.getPeakPosition()
+    reftd.setTDData(shifted)
 
 fig = plt.figure()
 ax = fig.add_subplot(2,1,1)
@@ -0,0 +1,71 @@
+import os
+import sys
+import unittest
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+from scipy.constants import c
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import TeraData
+import Terapy
+
+
+def syntheticHMeas(n=1.9-0.02j,l=500e-6,N=1400,dt=0.05e-12,noise=1e-6):
+    #the transfer function of a slab of thickness l and refractive index n, calculated from
+    #unwindowed synthetic reference and sample pulses
+    rng=np.random.RandomState(0)
+    t=np.arange(N)*dt
+    x=(t-10e-12)/0.3e-12
+    ref=-x*np.exp(-x**2)
+    f=np.fft.rfftfreq(N,dt)
+    n0=Terapy.teralyz.n_0.real
+    r=(n0-n)/(n0+n)
+    P=lambda m: np.exp(-2j*np.pi*f*l*m/c)
+    FP=sum((r**2*P(n)**2)**k for k in range(6))
+    H=4*n0*n/(n+n0)**2*P(n-n0)*FP
+    sam=np.fft.irfft(np.fft.rfft(ref)*H,N)
+    tds=[]
+    for X in (ref,sam):
+        X=X+rng.normal(0,noise,N)
+        unc=noise*np.ones(N)
+        tds.append(TeraData.THzTdData(np.column_stack((t,X,np.zeros(N),unc,unc)),existing=True))
+    return Terapy.HMeas(TeraData.FdData(tds[0]),TeraData.FdData(tds[1]),disableCut=True)
+
+
+class BatchedSolverTest(unittest.TestCase):
+
+    def test_batched_matches_neldermead(self):
+        #the batched solver has to give the same n as the simplex minimization for every bin
+        #of the spectrum, that carries signal (the synthetic pulse ends at about 3.5 THz)
+        l=500e-6
+        H=syntheticHMeas(l=l)
+        ana=Terapy.teralyz(H,l,headless=True)
+        H.manipulateFDData(-1,[100e9,3.5e12])
+        inits=np.asarray(ana.calculateinits(H.fdData,l))
+        nb,errb=ana.calculatenBatched(H.fdData,l,inits)
+        nn,errn=ana.calculatenNelderMead(H.fdData,l,inits)
+        self.assertTrue(np.all(np.isfinite(nb)))
+        self.assertLess(np.max(abs(nb-nn)),5e-4)
+        self.assertTrue(np.all(errb<=np.maximum(errn,1e-12)))
+        self.assertLess(np.max(abs(nb-(1.9-0.02j))),1e-2)
+
+    def test_batched_full_spectrum(self):
+        #above the signal band H_theory has many flat regions and solutions, there the
+        #batched solver must not report garbage as converged, every bin has to fit at least
+        #as well as with the simplex minimization
+        l=500e-6
+        for noise in (1e-4,1e-3):
+            H=syntheticHMeas(l=l,noise=noise)
+            ana=Terapy.teralyz(H,l,headless=True)
+            ix=H.getfreqs()>0
+            inits=np.asarray(ana.calculateinits(H.fdData,l))[:,ix]
+            nb,errb=ana.calculatenBatched(H.fdData[ix],l,inits)
+            nn,errn=ana.calculatenNelderMead(H.fdData[ix],l,inits)
+            self.assertTrue(np.all(np.isfinite(nb)))
+            self.assertLess(np.max(abs(nb)),10)
+            self.assertTrue(np.all(errb<=np.maximum(errn,1e-12)))
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import sys
+import unittest
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import TeraData
+import Terapy
+
+
+def randomSpectra(M=40,seed=0):
+    #random sample and reference spectra with uncertainties of their real and imaginary part,
+    #absolute value and phase
+    rng=np.random.RandomState(seed)
+    S=rng.normal(0,1,M)+1j*rng.normal(0,1,M)
+    R=rng.normal(0,1,M)+1j*rng.normal(0,1,M)
+    U=rng.uniform(0.01,0.1,(8,M))
+    return S,R,U
+
+def ratioUnc(S,R,U):
+    #propagateComplexUncArrays for H=S/R, U holds the uncertainties of real, imag, abs and
+    #phase of S (rows 0-3) and R (rows 4-7)
+    return TeraData.propagateComplexUncArrays(S/R,[S,R],[U[0],U[4]],[U[1],U[5]],
+                                              [U[2]/abs(S),U[6]/abs(R)],[U[3],U[7]],[1,-1])
+
+
+class ComplexUncertaintyTest(unittest.TestCase):
+
+    def test_ratio_matches_finite_differences(self):
+        #the propagated uncertainties of H=S/R have to agree with the ones from a finite
+        #difference Jacobian of H by the real and imaginary parts and by the absolute values
+        #and phases of S and R
+        S,R,U=randomSpectra()
+        unc=ratioUnc(S,R,U)
+        H=lambda S,R: S/R
+        eps=1e-6
+        #derivatives of H by real(S), imag(S), real(R), imag(R)
+        steps=[(eps,0),(1j*eps,0),(0,eps),(0,1j*eps)]
+        J=[(H(S+dS,R+dR)-H(S-dS,R-dR))/(2*eps) for dS,dR in steps]
+        u=[U[0],U[1],U[4],U[5]]
+        unc_real=np.sqrt(sum((Jk.real*uk)**2 for Jk,uk in zip(J,u)))
+        unc_imag=np.sqrt(sum((Jk.imag*uk)**2 for Jk,uk in zip(J,u)))
+        #derivatives of abs(H) by abs(S), abs(R) and of angle(H) by angle(S), angle(R)
+        polar=lambda A,phi: A*np.exp(1j*phi)
+        aS,pS,aR,pR=abs(S),np.angle(S),abs(R),np.angle(R)
+        dAbsS=(abs(H(polar(aS+eps,pS),R))-abs(H(polar(aS-eps,pS),R)))/(2*eps)
+        dAbsR=(abs(H(S,polar(aR+eps,pR)))-abs(H(S,polar(aR-eps,pR))))/(2*eps)
+        unc_abs=np.sqrt((dAbsS*U[2])**2+(dAbsR*U[6])**2)
+        dPhS=np.angle(H(polar(aS,pS+eps),R)/H(polar(aS,pS-eps),R))/(2*eps)
+        dPhR=np.angle(H(S,polar(aR,pR+eps))/H(S,polar(aR,pR-eps)))/(2*eps)
+        unc_ph=np.sqrt((dPhS*U[3])**2+(dPhR*U[7])**2)
+        expected=np.column_stack((unc_real,unc_imag,unc_abs,unc_ph))
+        np.testing.assert_allclose(unc,expected,rtol=1e-6)
+
+    def test_batch_broadcasts_over_samples(self):
+        #K sample spectra against one reference give the same rows as K single ratios
+        S,R,U=randomSpectra()
+        Ss=np.asarray([S,2*S,S*1j])
+        Us=[np.asarray([U[k]]*3) for k in range(4)]
+        unc=TeraData.propagateComplexUncArrays(Ss/R,[Ss,R],[Us[0],U[4]],[Us[1],U[5]],
+                                               [Us[2]/abs(Ss),U[6]/abs(R)],[Us[3],U[7]],[1,-1])
+        self.assertEqual(unc.shape,(3,len(S),4))
+        for k in range(3):
+            np.testing.assert_allclose(unc[k],ratioUnc(Ss[k],R,U),rtol=1e-12)
+
+    def test_fddata_uncertainties_are_computed(self):
+        #propagateComplexUnc reads the lazily computed uncertainties through the getters,
+        #so it works on freshly built FdData objects
+        N=400
+        t=np.arange(N)*0.05e-12
+        x=(t-5e-12)/0.3e-12
+        unc=1e-3*np.ones(N)
+        fds=[TeraData.FdData(TeraData.THzTdData(np.column_stack((t,A*x*np.exp(-x**2),np.zeros(N),unc,unc)),
+                                                existing=True)) for A in (-1,-0.5)]
+        S=fds[1].getFReal()+1j*fds[1].getFImag()
+        R=fds[0].getFReal()+1j*fds[0].getFImag()
+        H_unc=TeraData.propagateComplexUnc(S/R,[(fds[1],1),(fds[0],-1)])
+        self.assertTrue(np.all(np.isfinite(H_unc)))
+
+    def test_imaginary_uncertainty_of_ratio(self):
+        #regression for the sign of the 2*a*c*d term in d(Im H)/d(Re R), which the original
+        #HMeas.calculateFDunc had wrong, for S=1+2j, R=3+4j by hand:
+        #d(Im H)/d(real(R))=-(b*c**2-b*d**2-2*a*c*d)/abs(R)**4=38/625,
+        #the old sign gave -10/625 and an imaginary uncertainty of 0.0392884
+        S=np.array([1+2j])
+        R=np.array([3+4j])
+        U=np.array([[0.1],[0.2],[0.05],[0.01],[0.3],[0.4],[0.05],[0.01]])
+        unc=ratioUnc(S,R,U)[0]
+        self.assertAlmostEqual(unc[0],0.04633319328516005,places=14)
+        self.assertAlmostEqual(unc[1],0.0430492183436587,places=14)
+
+    def test_hmeas_imaginary_uncertainty(self):
+        #the imaginary uncertainty column of HMeas follows the corrected derivatives
+        N=400
+        t=np.arange(N)*0.05e-12
+        rng=np.random.RandomState(1)
+        tds=[]
+        for t0 in (5e-12,5.7e-12):
+            x=(t-t0)/0.3e-12
+            unc=rng.uniform(1e-3,2e-3,N)
+            tds.append(TeraData.THzTdData(np.column_stack((t,-x*np.exp(-x**2),np.zeros(N),unc,unc)),
+                                          existing=True))
+        H=Terapy.HMeas(TeraData.FdData(tds[0]),TeraData.FdData(tds[1]),disableCut=True)
+        a,b=H.fdsam.getFReal(),H.fdsam.getFImag()
+        c,d=H.fdref.getFReal(),H.fdref.getFImag()
+        r2=c**2+d**2
+        dgda=-d/r2
+        dgdb=c/r2
+        dgdc=-(b*c**2-b*d**2-2*a*c*d)/r2**2
+        dgdd=(a*d**2-a*c**2-2*b*c*d)/r2**2
+        expected=np.sqrt((H.fdsam.getFRealUnc()*dgda)**2+(H.fdsam.getFImagUnc()*dgdb)**2+
+                         (H.fdref.getFRealUnc()*dgdc)**2+(H.fdref.getFImagUnc()*dgdd)**2)
+        np.testing.assert_allclose(H.getFImagUnc(),expected,rtol=1e-10)
+
+
+if __name__=='__main__':
+    unittest.main()